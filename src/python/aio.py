@@ -0,0 +1,135 @@
+#! /usr/env python
+
+import asyncio
+from functools import partial
+from collections.abc import Mapping, Sequence, Set
+from constants import *
+from encoder import encode_many, string_types
+from decoder import TruncatedPayload, LimitExceeded, decode
+from validator import MAX_SIZE
+
+# Messages at least this many bytes long are decoded in an executor
+OFFLOAD_SIZE = 2**16
+# Containers with at least this many entries are encoded in an executor
+OFFLOAD_LENGTH = 2**10
+
+
+class MessageStream(object):
+    """ Sends and receives ProtoN messages over an asyncio stream. Each
+    message is framed as in a batch, by its length as a big-endian uint32,
+    so a recorded stream can be read back with decode_many. Large messages
+    are encoded and decoded in an executor to keep the event loop free.
+    @param {asyncio.StreamReader} reader - the stream to read messages from
+    @param {asyncio.StreamWriter} writer - the stream to write messages to
+    @param {int} offload_size - decode messages of at least this many bytes
+        in the executor
+    @param {int} offload_length - encode lists and objects with at least this
+        many entries at the top level in the executor
+    @param executor - the Executor to offload to, or None for the loop's
+        default executor
+    @param {str} arrays - how to return packed arrays, as in decode()
+    @param {bool} key_table - send repeated keys as back-references
+    @param {bool} packed_arrays - send numeric sequences as packed arrays
+    @param {int} max_size - longest message accepted, in bytes; a longer
+        frame length is rejected before any of the message is read, and a
+        compressed message is rejected once it expands past this
+    @param {Compression} compression - compress each message sent which
+        reaches the threshold
+    @param {bytes} dictionary - the preset dictionary of compressed messages
+        received
+    """
+
+    def __init__(self, reader, writer, offload_size=OFFLOAD_SIZE,
+                 offload_length=OFFLOAD_LENGTH, executor=None, arrays=None,
+                 key_table=False, packed_arrays=False, max_size=MAX_SIZE,
+                 compression=None, dictionary=None):
+        self.reader = reader
+        self.writer = writer
+        self.offload_size = offload_size
+        self.offload_length = offload_length
+        self.executor = executor
+        self.arrays = arrays
+        self.key_table = key_table
+        self.packed_arrays = packed_arrays
+        self.max_size = max_size
+        self.compression = compression
+        self.dictionary = dictionary
+
+    async def read(self):
+        """ Reads and decodes the next message. Raises EOFError if the stream
+        ends between messages, TruncatedPayload if it ends within one, or
+        LimitExceeded if the message, or the one it holds if compressed, is
+        longer than max_size """
+        try:
+            head = await self.reader.readexactly(FRAME_LENGTH_BYTES)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise TruncatedPayload("Stream ended within a message length")
+            raise EOFError("ProtoN stream closed")
+        length = int.from_bytes(head, 'big')
+        if length > self.max_size:
+            raise LimitExceeded("Message longer than the limit. Got:", length)
+        try:
+            payload = await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise TruncatedPayload("Stream ended within a message")
+        if length >= self.offload_size:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, partial(decode, payload, arrays=self.arrays,
+                                       dictionary=self.dictionary, max_size=self.max_size))
+        return decode(payload, arrays=self.arrays, dictionary=self.dictionary,
+                      max_size=self.max_size)
+
+    async def write(self, data):
+        """ Encodes and sends a message, waiting for the transport's buffer
+        to drain below its high-water mark before returning """
+        batch = partial(encode_many, (data,), self.key_table, self.packed_arrays,
+                        compression=self.compression)
+        if (isinstance(data, (Mapping, Sequence, Set)) and not isinstance(data, string_types)
+                and len(data) >= self.offload_length):
+            frame = await asyncio.get_running_loop().run_in_executor(self.executor, batch)
+        else:
+            frame = batch()
+        self.writer.write(frame)
+        await self.writer.drain()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.read()
+        except EOFError:
+            raise StopAsyncIteration
+
+    async def close(self):
+        """ Closes the underlying stream """
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def connect(host=None, port=None, path=None, **options):
+    """ Opens a MessageStream to a TCP server or, if `path` is given, to a
+    Unix socket. Other options are passed on to MessageStream. """
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    return MessageStream(reader, writer, **options)
+
+
+async def serve(handler, host=None, port=None, path=None, **options):
+    """ Starts a TCP server or, if `path` is given, a Unix socket server
+    which calls the coroutine `handler` with a MessageStream for each
+    connection, closing the stream once it returns. Other options are
+    passed on to MessageStream. Returns the asyncio Server. """
+    async def accept(reader, writer):
+        stream = MessageStream(reader, writer, **options)
+        try:
+            await handler(stream)
+        finally:
+            await stream.close()
+    if path is not None:
+        return await asyncio.start_unix_server(accept, path)
+    return await asyncio.start_server(accept, host, port)
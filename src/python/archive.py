@@ -0,0 +1,156 @@
+#! /usr/env python
+
+from constants import *
+from os import cpu_count, stat
+from os.path import exists, getsize
+from mmap import mmap, ACCESS_READ
+from array import array
+from sys import byteorder
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from decoder import TruncatedPayload, decode_many
+
+# Appended to the path of a batch file to name its sidecar index
+INDEX_SUFFIX = '.idx'
+# Number of records decoded by each task handed to the pool
+RECORDS_PER_TASK = 4096
+# Number of tasks kept in flight per worker, which bounds memory use
+TASKS_PER_WORKER = 2
+
+
+def build_index(path, offsets=None):
+    """ Scans the message lengths of a batch file, as written by encode_many,
+    and returns an array of the byte offset of every record followed by the
+    offset at which the last one ends
+    @param {str} path - the batch file to index
+    @param {array} offsets - an index of the start of the file to extend
+    """
+    offsets = array('Q', [0]) if offsets is None else offsets
+    size = getsize(path)
+    if offsets[-1] == size:
+        return offsets
+    with open(path, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+        pos = offsets[-1]
+        while pos < size:
+            body = pos + FRAME_LENGTH_BYTES
+            if body > size:
+                raise TruncatedPayload("Batch ended within a message length")
+            pos = body + int.from_bytes(data[pos:body], 'big')
+            if pos > size:
+                raise TruncatedPayload("Batch ended within a message")
+            offsets.append(pos)
+    return offsets
+
+
+def save_index(offsets, path, mtime):
+    """ Writes an index to `path` as big-endian uint64s: the modification
+    time of the batch file it was built from, then the offsets
+    @param {int} mtime - the batch file's st_mtime_ns when it was scanned
+    """
+    entries = array('Q', [mtime])
+    entries.extend(offsets)
+    if byteorder == 'little':
+        entries.byteswap()
+    with open(path, 'wb') as f:
+        entries.tofile(f)
+
+
+def load_index(path):
+    """ Reads an index written by save_index, and returns the modification
+    time it holds and its offsets """
+    offsets = array('Q')
+    with open(path, 'rb') as f:
+        offsets.frombytes(f.read())
+    if byteorder == 'little':
+        offsets.byteswap()
+    if not offsets:
+        return None, None
+    return offsets[0], offsets[1:]
+
+
+def index_file(path, index_path=None):
+    """ Returns the index of a batch file, loading its sidecar index if there
+    is one. The index is only used if the file has the size and modification
+    time it had when it was scanned. Otherwise the file may have been
+    rewritten rather than appended to, so every record is scanned again.
+    @param {str} path - the batch file
+    @param {str} index_path - the sidecar index, by default `path` + '.idx'
+    """
+    if index_path is None:
+        index_path = path + INDEX_SUFFIX
+    mtime, offsets = load_index(index_path) if exists(index_path) else (None, None)
+    # Taken before the scan, so a write during it leaves the index stale
+    status = stat(path)
+    if offsets and offsets[-1] == status.st_size and mtime == status.st_mtime_ns:
+        return offsets
+    offsets = build_index(path)
+    save_index(offsets, index_path, status.st_mtime_ns)
+    return offsets
+
+
+def decode_range(path, start, end, arrays=None, dictionary=None):
+    """ Decodes the records between two byte offsets of a batch file, reading
+    them straight from a memory map of the file """
+    with open(path, 'rb') as f:
+        # The map is closed once nothing refers to it, as NumPy arrays may
+        data = mmap(f.fileno(), 0, access=ACCESS_READ)
+    return decode_many(data, arrays, start, end, dictionary)
+
+
+def collect_completed(pending):
+    """ Waits for at least one pending range and yields the (record number,
+    object) pairs of every range which has completed """
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        first = pending.pop(future)
+        for i, obj in enumerate(future.result(), first):
+            yield i, obj
+
+
+def decode_file(path, workers=None, ordered=True, arrays=None, index_path=None,
+                records_per_task=RECORDS_PER_TASK, dictionary=None):
+    """ Decodes every record of a batch file, as written by encode_many,
+    splitting the records into ranges which a pool of processes decode from
+    a memory map of the file. The ranges are found through the file's
+    sidecar index, which is built or extended first if needed.
+    Objects are yielded in file order or, if `ordered` is False, as
+    (record number, object) pairs as soon as their range is decoded.
+    @param {str} path - the batch file to decode
+    @param workers - number of worker processes, or an Executor to use
+    @param {bool} ordered - yield records in file order
+    @param {str} arrays - how to return packed arrays, as in decode()
+    @param {str} index_path - the sidecar index, by default `path` + '.idx'
+    @param {int} records_per_task - number of records in each range
+    @param {bytes} dictionary - the preset dictionary of compressed records
+    """
+    offsets = index_file(path, index_path)
+    count = len(offsets) - 1
+    ranges = ((i, offsets[i], offsets[min(i + records_per_task, count)])
+              for i in range(0, count, records_per_task))
+    if isinstance(workers, Executor):
+        executor, limit = workers, cpu_count() or 1
+    else:
+        executor, limit = ProcessPoolExecutor(workers), workers or cpu_count() or 1
+    limit *= TASKS_PER_WORKER
+    try:
+        if ordered:
+            queue = deque()
+            for first, start, end in ranges:
+                queue.append(executor.submit(decode_range, path, start, end, arrays,
+                                             dictionary))
+                if len(queue) >= limit:
+                    yield from queue.popleft().result()
+            while queue:
+                yield from queue.popleft().result()
+        else:
+            pending = {}
+            for first, start, end in ranges:
+                future = executor.submit(decode_range, path, start, end, arrays, dictionary)
+                pending[future] = first
+                if len(pending) >= limit:
+                    yield from collect_completed(pending)
+            while pending:
+                yield from collect_completed(pending)
+    finally:
+        if executor is not workers:
+            executor.shutdown()
@@ -0,0 +1,230 @@
+#! /usr/env python
+
+from constants import *
+from collections import Counter
+import zlib
+import lzma
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codec of each codec name
+codec_names = {'zlib': CODEC_ZLIB, 'lzma': CODEC_LZMA, 'zstd': CODEC_ZSTD}
+# Errors the codecs raise for malformed streams
+codec_errors = (zlib.error, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard else ())
+
+# Default size in bytes below which messages are sent uncompressed
+COMPRESSION_THRESHOLD = 2**9
+# Default size of a trained dictionary, and length of the fragments it is
+# built from
+DICTIONARY_SIZE = 2**14
+DICTIONARY_FRAGMENT = 8
+# Bytes of a zstd stream fed to a decompressor at a time when its output is
+# bounded. A zstd block of at most 128 KB takes at least 4 bytes, so this
+# bounds the output past a limit to about 1 MB.
+ZSTD_SLICE = 2**5
+# Header of every compressed message, which uses no other extension
+COMPRESSED_HEADER = bytes([(PROTOCOL_VERSION << 6) | FLAG_COMPRESSED])
+
+
+class Compression(object):
+    """ How messages are compressed. A compressed message is a header with
+    only the compression flag set, the codec, and the compressed stream of
+    the message as it would otherwise have been sent.
+    @param {str} codec - 'zlib', 'lzma' or 'zstd', which requires the
+        zstandard package
+    @param {int} threshold - messages shorter than this many bytes are sent
+        uncompressed
+    @param {bytes} dictionary - a preset dictionary, such as one built by
+        train_dictionary(), which decoding must be given as well. lzma does
+        not support preset dictionaries.
+    @param {int} level - the compression level, or None for the default
+    """
+
+    def __init__(self, codec='zlib', threshold=COMPRESSION_THRESHOLD, dictionary=None,
+                 level=None):
+        if codec not in codec_names:
+            raise ValueError("Unknown compression codec. Got:", codec)
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError("The zstandard package is required for zstd compression")
+        if codec == 'lzma' and dictionary is not None:
+            raise ValueError("lzma does not support preset dictionaries")
+        self.codec = codec_names[codec]
+        self.threshold = threshold
+        self.dictionary = dictionary
+        self.level = level
+
+    def compressor(self):
+        """ Returns a new compressor, with `compress` and `flush` methods """
+        if self.codec == CODEC_ZLIB:
+            level = zlib.Z_DEFAULT_COMPRESSION if self.level is None else self.level
+            if self.dictionary is None:
+                return zlib.compressobj(level)
+            return zlib.compressobj(level, zdict=self.dictionary)
+        elif self.codec == CODEC_LZMA:
+            return lzma.LZMACompressor(check=lzma.CHECK_NONE, preset=self.level)
+        return zstandard.ZstdCompressor(
+            level=3 if self.level is None else self.level,
+            dict_data=zstd_dictionary(self.dictionary)).compressobj()
+
+    def compress_message(self, message):
+        """ Returns a message compressed, or unchanged if it is shorter than
+        the threshold or does not get any shorter """
+        if len(message) < self.threshold:
+            return message
+        compressor = self.compressor()
+        compressed = (COMPRESSED_HEADER + bytes([self.codec])
+                      + compressor.compress(message) + compressor.flush())
+        return compressed if len(compressed) < len(message) else message
+
+    def stream(self, writable):
+        """ Returns a CompressedWriter compressing a message into `writable` """
+        return CompressedWriter(self, writable)
+
+
+class CompressedWriter(object):
+    """ Writable which compresses the message written to it in pieces as
+    they arrive, and writes the result to another writable. The first bytes
+    are held back until the message reaches the compression threshold, and
+    are written uncompressed if it never does.
+    @param {Compression} compression - how the message is compressed
+    @param writable - object with a `write` method accepting bytes
+    """
+
+    def __init__(self, compression, writable):
+        self.compression = compression
+        self.writable = writable
+        self.pending = bytearray()
+        self.compressor = None
+        self.written = 0
+
+    def write(self, data):
+        if self.compressor is None:
+            self.pending += data
+            if len(self.pending) < self.compression.threshold:
+                return
+            self.compressor = self.compression.compressor()
+            self.emit(COMPRESSED_HEADER + bytes([self.compression.codec]))
+            data, self.pending = bytes(self.pending), None
+        self.emit(self.compressor.compress(data))
+
+    def close(self):
+        """ Writes out the rest of the message and returns the number of
+        bytes written """
+        if self.compressor is None:
+            self.emit(bytes(self.pending))
+        else:
+            self.emit(self.compressor.flush())
+        return self.written
+
+    def emit(self, data):
+        if data:
+            self.writable.write(data)
+            self.written += len(data)
+
+
+def zstd_dictionary(dictionary):
+    """ Returns a zstd dictionary: a trained zstd dictionary as is, and any
+    other bytes as raw content """
+    if dictionary is None:
+        return None
+    return zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_AUTO)
+
+
+def decompressor(codec, dictionary=None):
+    """ Returns a new decompressor for a codec, with `decompress`, `eof` and
+    `unused_data`
+    @param {int} codec - the CODEC_* of the message
+    @param {bytes} dictionary - the preset dictionary the message used
+    """
+    if codec == CODEC_ZLIB:
+        if dictionary is None:
+            return zlib.decompressobj()
+        return zlib.decompressobj(zdict=dictionary)
+    elif codec == CODEC_LZMA:
+        return lzma.LZMADecompressor()
+    elif codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ImportError("The zstandard package is required for zstd compression")
+        return zstandard.ZstdDecompressor(dict_data=zstd_dictionary(dictionary)).decompressobj()
+    raise ValueError("Unknown compression codec. Got:", codec)
+
+
+def decompress(codec, data, dictionary=None, max_size=None):
+    """ Returns the message held by the compressed stream of a compressed
+    message, which must end exactly at the end of the data. If `max_size` is
+    given, returns None for a message longer than that many bytes, which is
+    found without producing more than one byte past the limit.
+    @param {int} codec - the CODEC_* of the message
+    @param {bytes} data - the compressed stream
+    @param {bytes} dictionary - the preset dictionary the message used
+    @param {int} max_size - longest message to decompress, or None
+    """
+    stream = decompressor(codec, dictionary)
+    try:
+        if max_size is None:
+            message = stream.decompress(data)
+        elif codec == CODEC_ZSTD:
+            # zstd decompressors cannot bound their output, so the message is
+            # first measured by a bounded read
+            source = zstandard.ZstdDecompressor(
+                dict_data=zstd_dictionary(dictionary)).stream_reader(data, read_across_frames=False)
+            if len(source.read(max_size + 1)) > max_size:
+                return None
+            message = stream.decompress(data)
+        else:
+            message = stream.decompress(data, max_size + 1)
+            if len(message) > max_size:
+                return None
+    except codec_errors as error:
+        raise ValueError("Malformed compressed message:", error)
+    if not stream.eof:
+        raise ValueError("Compressed message ended unexpectedly")
+    if stream.unused_data:
+        raise ValueError("Compressed message continues after its stream")
+    return message
+
+
+def decompress_more(stream, codec, data, max_size):
+    """ Feeds the next bytes of a compressed stream to a decompressor from
+    decompressor() and returns the output, or None if it would be longer
+    than `max_size` bytes, which is found without producing much more
+    @param stream - the decompressor
+    @param {int} codec - the CODEC_* of the stream
+    @param {bytes} data - the next bytes of the stream
+    @param {int} max_size - most bytes of output to accept, or None
+    """
+    if max_size is None:
+        return stream.decompress(data)
+    if codec != CODEC_ZSTD:
+        # zlib and lzma stop once they produce max_length bytes
+        output = stream.decompress(data, max_size + 1)
+        return None if len(output) > max_size else output
+    output = bytearray()
+    for start in range(0, len(data), ZSTD_SLICE):
+        output += stream.decompress(data[start:start + ZSTD_SLICE])
+        if len(output) > max_size:
+            return None
+    return bytes(output)
+
+
+def train_dictionary(messages, size=DICTIONARY_SIZE):
+    """ Builds a preset dictionary for zlib or zstd from sample messages. It
+    holds the fragments found in the most messages, with the most common
+    last, as compressors reach the end of a dictionary most cheaply.
+    @param {list} messages - encoded sample messages
+    @param {int} size - the most bytes the dictionary holds
+    """
+    counts = Counter()
+    for message in messages:
+        counts.update(set(message[i:i + DICTIONARY_FRAGMENT]
+                          for i in range(len(message) - DICTIONARY_FRAGMENT + 1)))
+    fragments = []
+    length = 0
+    for fragment, count in counts.most_common():
+        if count < 2 or length + len(fragment) > size:
+            break
+        fragments.append(fragment)
+        length += len(fragment)
+    return b''.join(reversed(fragments))
@@ -6,7 +6,27 @@
 ## This code should never be executed by itself, but rather imported as an
 ## typecode reference.
 ##
-PROTOCOL_VERSION = 0x1
+PROTOCOL_VERSION = 0x2
+# Version of messages which use no extensions
+BASE_PROTOCOL_VERSION = 0x1
+
+# Number of bytes of the big-endian length which precedes each message in a
+# batch of length-delimited messages
+FRAME_LENGTH_BYTES = 4
+
+# Extension flags, sent as a uint6 after the version of version 2 messages
+FLAG_KEY_TABLE = 0x1
+FLAG_EXTENDED_TYPES = 0x2
+FLAG_VARINTS = 0x4
+FLAG_STRING_TABLE = 0x8
+FLAG_COMPRESSED = 0x10
+SUPPORTED_FLAGS = FLAG_KEY_TABLE | FLAG_EXTENDED_TYPES | FLAG_VARINTS | FLAG_STRING_TABLE \
+    | FLAG_COMPRESSED
+
+# Codecs of compressed messages, sent as a uint8 after the header
+CODEC_ZLIB = 0x1
+CODEC_LZMA = 0x2
+CODEC_ZSTD = 0x3
 
 TYPE_NULL = 0x0
 TYPE_STRING = 0x1
@@ -18,3 +38,18 @@ TYPE_PAIR = 0x5
 
 TYPE_LIST = 0x6
 TYPE_OBJECT = 0x7
+
+# With FLAG_EXTENDED_TYPES, a TYPE_PAIR code where a value is expected is
+# followed by a uint3 extended type
+TYPE_EXTENSION = TYPE_PAIR
+EXT_PACKED_ARRAY = 0x0
+EXT_CHUNKED_LIST = 0x1
+
+# Element types of packed arrays
+PACKED_INT8 = 0x0
+PACKED_INT16 = 0x1
+PACKED_INT32 = 0x2
+PACKED_INT64 = 0x3
+PACKED_FLOAT32 = 0x4
+PACKED_FLOAT64 = 0x5
+PACKED_UINT8 = 0x6
@@ -1,152 +1,1151 @@
 #! /usr/env python
 
 from constants import *
-from struct import pack, unpack, calcsize
-from bitstring import Bits, BitStream
+from compression import decompress, decompressor, decompress_more, codec_errors
+from struct import unpack, Struct
+from re import compile as compile_regex
+from array import array
+from sys import byteorder
+from collections import OrderedDict
+try:
+    import numpy
+except ImportError:
+    numpy = None
 primitive_type_codes = set([TYPE_NULL, TYPE_BOOL, TYPE_INT, TYPE_STRING, TYPE_FLOAT])
 
+# Selector step matching every element of a list, written `[*]`
+WILDCARD = object()
+# Returned by decode_selected for a value outside the selection
+NOT_SELECTED = object()
+# One step of a selector path: a key, optionally preceded by a dot, or [i]/[*]
+selector_step = compile_regex(r'\.?([^.\[\]]+)|\[(\*|-?\d+)\]')
 
-def decode(payload):
-    payload = BitStream(payload)
-    version, payload = decode_version(payload)
-    assert(version == PROTOCOL_VERSION)
-    return decode_object(payload)[0]
+# array typecode and element size of each packed element type
+packed_formats = {
+    PACKED_INT8: 'b',
+    PACKED_INT16: 'h',
+    PACKED_INT32: dict((array(tc).itemsize, tc) for tc in 'ilq')[4],
+    PACKED_INT64: dict((array(tc).itemsize, tc) for tc in 'ilq')[8],
+    PACKED_FLOAT32: 'f',
+    PACKED_FLOAT64: 'd',
+    PACKED_UINT8: 'B',
+}
+packed_sizes = dict((t, array(tc).itemsize) for t, tc in packed_formats.items())
+# Big-endian NumPy dtype of each packed element type
+packed_dtypes = {
+    PACKED_INT8: 'i1', PACKED_INT16: '>i2', PACKED_INT32: '>i4',
+    PACKED_INT64: '>i8', PACKED_FLOAT32: '>f4', PACKED_FLOAT64: '>f8',
+    PACKED_UINT8: 'u1',
+}
 
+# Events emitted by StreamDecoder, each paired with a value
+START_OBJECT = 'start_object'
+END_OBJECT = 'end_object'
+START_LIST = 'start_list'
+END_LIST = 'end_list'
+KEY = 'key'
+VALUE = 'value'
 
-def decode_version(payload):
-    version, payload = payload.readlist(['uint:2, bits'])
-    return version, payload
+# Mask of the low n bits, for each n a scalar or its window can span
+bit_masks = [(1 << n) - 1 for n in range(89)]
+unpack_float64 = Struct('>d').unpack
 
+# Most keys a Decoder keeps decoded between messages
+KEY_CACHE_SIZE = 2**12
 
-def decode_object(payload):
-    assert(payload is not None)
-    if len(payload) == 0:
-        return
-    dtype, payload = unpack_dtype(payload)
-    # print('dtype:', dtype, 'payload:', payload[:8])
+# What StreamDecoder expects to read next
+EXPECT_VERSION = 0
+EXPECT_VALUE = 1
+EXPECT_PAIR = 2
+EXPECT_CHUNK = 3
+EXPECT_CODEC = 4
+EXPECT_COMPRESSED = 5
+EXPECT_END = 6
 
-    if dtype in primitive_type_codes:
-        return unpack_primitive(payload, dtype)
-    elif dtype == TYPE_LIST:
-        length, payload = unpack_len(payload)
-        list_obj = []
-        for _ in range(length):
-            elt, payload = decode_object(payload)
-            list_obj.append(elt)
-        return list_obj, payload
-    elif dtype == TYPE_OBJECT:
-        length, payload = unpack_len(payload)
-        dict_obj = {}
-        for _ in range(length):
-            key, value, payload = decode_pair(payload)
-            dict_obj[key] = value
-        return dict_obj, payload
+
+class TruncatedPayload(ValueError):
+    """ Raised when a payload ends in the middle of a field """
+
+
+class LimitExceeded(ValueError):
+    """ Raised when a message is well formed but exceeds a limit """
+
+
+class BitReader(object):
+    """ Reads big-endian bit fields from an immutable buffer by advancing a
+    single bit position, so no part of the payload is copied per field.
+    Buffers other than bytes, such as a bytearray or mmap, are read through
+    a memoryview rather than copied.
+    @param {bytes} payload - the buffer to read from
+    """
+
+    def __init__(self, payload):
+        if not isinstance(payload, bytes):
+            payload = memoryview(payload).cast('B')
+        self.payload = payload
+        self.pos = 0
+        self.end = len(payload) << 3
+        # Extensions used by the message, and every key received so far
+        # when the key table is enabled
+        self.flags = 0
+        self.keys = None
+        # String of each slot of the string table, least recently used
+        # first, when it is enabled, and the number of slots
+        self.strings = None
+        self.string_table_size = 0
+        # Type packed arrays are returned as: None (list), 'array' or 'numpy'
+        self.arrays = None
+        # Key of each key's bytes, kept across messages by a Decoder, or None
+        self.key_cache = None
+
+    def read(self, width):
+        """ Reads the next `width` bits as an unsigned int """
+        pos = self.pos
+        end = pos + width
+        if end > self.end:
+            raise TruncatedPayload("ProtoN payload ended unexpectedly")
+        last = (end + 7) >> 3
+        chunk = int.from_bytes(self.payload[pos >> 3:last], 'big')
+        self.pos = end
+        return (chunk >> ((last << 3) - end)) & ((1 << width) - 1)
+
+    def skip(self, width):
+        """ Advances past the next `width` bits without reading them """
+        end = self.pos + width
+        if end > self.end:
+            raise TruncatedPayload("ProtoN payload ended unexpectedly")
+        self.pos = end
+
+    def align(self):
+        """ Advances to the next byte boundary """
+        self.skip(-self.pos & 7)
+
+    def read_bytes(self, length):
+        """ Reads the next `length` bytes, which need not be byte-aligned """
+        pos = self.pos
+        if pos & 7:
+            return self.read(length << 3).to_bytes(length, 'big')
+        end = pos + (length << 3)
+        if end > self.end:
+            raise TruncatedPayload("ProtoN payload ended unexpectedly")
+        self.pos = end
+        return bytes(self.payload[pos >> 3:end >> 3])
+
+    def read_string(self, length):
+        """ Reads the next `length` bytes as UTF-8, decoding them straight
+        from the payload when they are byte-aligned """
+        pos = self.pos
+        if pos & 7:
+            return self.read_bytes(length).decode('utf-8')
+        end = pos + (length << 3)
+        if end > self.end:
+            raise TruncatedPayload("ProtoN payload ended unexpectedly")
+        self.pos = end
+        chunk = self.payload[pos >> 3:end >> 3]
+        if chunk.__class__ is bytes:
+            return chunk.decode('utf-8')
+        return str(chunk, 'utf-8')
+
+    def release(self):
+        """ Releases the view of a payload which is not bytes, after which
+        the buffer may be resized or closed """
+        if isinstance(self.payload, memoryview):
+            self.payload.release()
+
+
+def decode(payload, select=None, arrays=None, dictionary=None, max_size=None):
+    """ Decodes a ProtoN message. If `select` is given, only the listed key
+    paths are decoded; every other subtree is skipped by reading just its
+    dtypes and length prefixes. The result keeps the shape of the message,
+    pruned to the selected paths.
+    @param {bytes} payload - the ProtoN message to decode, which may also be
+        a bytearray, memoryview or mmap to read from without copying it
+    @param {list} select - paths such as "user.name" or "items[*].id"
+    @param {str} arrays - return packed arrays as lists (None), array.array
+        ('array') or NumPy arrays reading straight from the payload ('numpy')
+    @param {bytes} dictionary - the preset dictionary compressed messages
+        were compressed with, if any
+    @param {int} max_size - longest message a compressed message may hold,
+        in bytes, or None for no limit; a longer one raises LimitExceeded
+    """
+    if arrays == 'numpy' and numpy is None:
+        raise ImportError("NumPy is required to decode packed arrays as ndarrays")
+    reader = BitReader(payload)
+    reader.arrays = arrays
+    reader = open_message(reader, dictionary, max_size)
+    if select is None:
+        return decode_object(reader)
+    value = decode_selected(reader, compile_selection(select))
+    return None if value is NOT_SELECTED else value
+
+
+def decode_many(payload, arrays=None, start=0, end=None, dictionary=None, max_size=None):
+    """ Decodes a batch of length-delimited messages, as written by
+    encode_many, through a single reader and returns the list of objects
+    @param {bytes} payload - the batch to decode
+    @param {str} arrays - how to return packed arrays, as in decode()
+    @param {int} start - byte offset of the first message to decode
+    @param {int} end - byte offset at which the batch ends, or None for all
+    @param {bytes} dictionary - the preset dictionary of compressed messages
+    @param {int} max_size - longest message a compressed message may hold,
+        as in decode()
+    """
+    reader = BitReader(payload)
+    reader.arrays = arrays
+    size = len(payload) if end is None else end
+    objects = []
+    while start < size:
+        body = start + FRAME_LENGTH_BYTES
+        if body > size:
+            raise TruncatedPayload("Batch ended within a message length")
+        end = body + int.from_bytes(payload[start:body], 'big')
+        if end > size:
+            raise TruncatedPayload("Batch ended within a message")
+        # Reads are confined to the message
+        reader.pos = body << 3
+        reader.end = end << 3
+        objects.append(decode_object(open_message(reader, dictionary, max_size)))
+        start = end
+    return objects
 
 
-def unpack_dtype(payload):
-    """Reads the type of data stipulated at the head of a bytestring"""
-    dtype, payload = payload.readlist(['uint:3, bits'])
-#     print("unpacked dtype", dtype)
-    return dtype, payload
+class Decoder(object):
+    """ Decoder for servers which decode many messages, such as one kept per
+    thread or worker. It keeps every key it has decoded, so a key is only
+    decoded the first time and the objects of all its messages share one
+    string per key. A Decoder must not be shared between threads.
+    @param {str} arrays - how to return packed arrays, as in decode()
+    @param {bytes} dictionary - the preset dictionary of compressed messages
+    @param {int} max_size - longest message a compressed message may hold,
+        as in decode()
+    """
+
+    def __init__(self, arrays=None, dictionary=None, max_size=None):
+        if arrays == 'numpy' and numpy is None:
+            raise ImportError("NumPy is required to decode packed arrays as ndarrays")
+        self.arrays = arrays
+        self.dictionary = dictionary
+        self.max_size = max_size
+        self.key_cache = {}
+
+    def decode(self, payload, select=None):
+        """ Decodes a ProtoN message, as decode() does
+        @param {bytes} payload - the ProtoN message to decode
+        @param {list} select - paths such as "user.name" or "items[*].id"
+        """
+        reader = BitReader(payload)
+        reader.arrays = self.arrays
+        reader.key_cache = self.key_cache
+        reader = open_message(reader, self.dictionary, self.max_size)
+        if select is None:
+            return decode_object(reader)
+        value = decode_selected(reader, compile_selection(select))
+        return None if value is NOT_SELECTED else value
+
+
+def decode_version(reader):
+    return reader.read(2)
+
+
+def decode_header(reader):
+    """ Reads the version and extension flags which open a message, sets up
+    the reader for those extensions and returns the flags """
+    version = decode_version(reader)
+    if version == PROTOCOL_VERSION:
+        flags = reader.read(6)
+    elif version == BASE_PROTOCOL_VERSION:
+        flags = 0
+    else:
+        raise ValueError("Unsupported ProtoN version. Got:", version)
+    if flags & ~SUPPORTED_FLAGS:
+        raise ValueError("Unsupported ProtoN extension flags. Got:", flags)
+    if flags & FLAG_COMPRESSED and flags != FLAG_COMPRESSED:
+        raise ValueError("A compressed message uses no other extension. Got:", flags)
+    reader.flags = flags
+    reader.keys = [] if flags & FLAG_KEY_TABLE else None
+    if flags & FLAG_STRING_TABLE:
+        size = unpack_len(reader)
+        if size < 1:
+            raise ValueError("The string table needs at least one slot. Got:", size)
+        reader.strings = OrderedDict()
+        reader.string_table_size = size
+    else:
+        reader.strings = None
+    return flags
+
+
+def open_message(reader, dictionary=None, max_size=None):
+    """ Reads the header of the message at the reader's position and returns
+    a reader positioned at its first dtype: the same reader, or for a
+    compressed message a reader of the message it holds, which is
+    decompressed in full. Decompression stops a byte past `max_size`, so a
+    hostile stream cannot expand without bound.
+    @param {BitReader} reader - reader positioned at the message's header
+    @param {bytes} dictionary - the preset dictionary of compressed messages
+    @param {int} max_size - longest message a compressed message may hold,
+        in bytes, or None for no limit
+    """
+    if not decode_header(reader) & FLAG_COMPRESSED:
+        return reader
+    codec = reader.read(8)
+    message = decompress(codec, reader.payload[reader.pos >> 3:reader.end >> 3], dictionary,
+                         max_size)
+    if message is None:
+        raise LimitExceeded("Compressed message holds more bytes than the limit")
+    inner = BitReader(message)
+    inner.arrays = reader.arrays
+    inner.key_cache = reader.key_cache
+    if decode_header(inner) & FLAG_COMPRESSED:
+        raise ValueError("A compressed message holds another compressed message")
+    return inner
 
 
-def unpack_primitive(payload, dtype):
-    """ Unpacks a primitive from the given payload and returns the remaining
-        subsequent payload. Infers the type of data via the dtype at the beginning.
-    @param {bytes} payload - the raw bytes of data to unpack as per the
-        spec in wire_protocol.md
+def decode_object(reader):
+    """ Decodes the object at the reader's position. Containers are filled
+    from an explicit stack rather than through recursion, so nesting depth is
+    not bounded by the recursion limit.
+    @param {BitReader} reader - reader positioned at the object's dtype
+    """
+    read = reader.read
+    varints = reader.flags & FLAG_VARINTS
+    unpackers = flag_unpackers[reader.flags & UNPACKER_FLAGS]
+    # [container, remaining entries, is object, is chunked] of each unfilled
+    # container, where the entries of a chunked list remain in its chunk
+    stack = []
+    parent = None
+    while True:
+        if parent is not None and parent[2]:
+            if read(3) != TYPE_PAIR:
+                raise ValueError("Expected a pair dtype in object")
+            key = unpack_key(reader)
+        dtype = read(3)
+
+        length = chunked = 0
+        if dtype in unpackers:
+            value = unpackers[dtype](reader)
+        elif dtype == TYPE_LIST:
+            length = unpack_varint(reader) if varints else read(8 << read(2))
+            value = []
+        elif dtype == TYPE_OBJECT:
+            length = unpack_varint(reader) if varints else read(8 << read(2))
+            value = {}
+        elif dtype == TYPE_EXTENSION and reader.flags & FLAG_EXTENDED_TYPES:
+            if read(3) == EXT_CHUNKED_LIST:
+                length, chunked = unpack_len(reader), True
+                value = []
+            else:
+                reader.pos -= 3
+                value = unpack_extension(reader)
+        else:
+            raise ValueError("Expected a primitive or container dtype. Got:", dtype)
+
+        if parent is None:
+            root = value
+        else:
+            if parent[2]:
+                parent[0][key] = value
+            else:
+                parent[0].append(value)
+            parent[1] -= 1
+        if length:
+            parent = [value, length, dtype == TYPE_OBJECT, chunked]
+            stack.append(parent)
+            continue
+        # Close every container completed by this value, reading the next
+        # chunk of a chunked list once its last chunk is used up
+        while stack and not stack[-1][1]:
+            if stack[-1][3]:
+                stack[-1][1] = unpack_len(reader)
+                if stack[-1][1]:
+                    break
+            stack.pop()
+        if not stack:
+            return root
+        parent = stack[-1]
+
+
+def unpack_dtype(reader):
+    """Reads the type of data stipulated at the reader's position"""
+    return reader.read(3)
+
+
+def unpack_primitive(reader, dtype):
+    """ Unpacks a primitive from the given reader, advancing it past the
+        value. Infers the type of data via the dtype at the beginning.
+    @param {BitReader} reader - the reader positioned at the raw data to
+        unpack as per the spec in wire_protocol.md
     """
     if dtype == TYPE_NULL:
-        return unpack_null(payload)
+        return unpack_null(reader)
     elif dtype == TYPE_STRING:
-        return unpack_string(payload)
+        if reader.strings is not None:
+            return unpack_table_string(reader)
+        return unpack_string(reader)
     elif dtype == TYPE_INT:
-        return unpack_int(payload)
+        if reader.flags & FLAG_VARINTS:
+            return unpack_zigzag(reader)
+        return unpack_int(reader)
     elif dtype == TYPE_BOOL:
-        return unpack_boolean(payload)
+        return unpack_boolean(reader)
     elif dtype == TYPE_FLOAT:
-        return unpack_float(payload)
+        return unpack_float(reader)
     else:
         raise ValueError("Primitive dtype not recognized. Got:", dtype, ". Please\
         consult the specification for acceptable primitive type codes.")
 
 
-def unpack_float(payload):
-    """ Unpacks a float from the given payload and returns the remaining
-        subsequent payload
-    @param {bytes} payload - raw bytes at whose head is float data to
+def unpack_float(reader):
+    """ Unpacks a float from the given reader
+    @param {BitReader} reader - reader positioned at float data to
         unpack as per the spec in wire_protocol.md
     """
-    is_float64, payload = unpack_boolean(payload)
-    if is_float64:
-        float_value, payload = payload.readlist(['float:64, bits'])
-    else:
-        float_str, payload = unpack_string(payload, short=True)
-        float_value = float(float_str)
-    return float_value, payload
+    pos = reader.pos
+    start = pos >> 3
+    # The flag and either form of the float lie within the next 9 bytes,
+    # which are loaded as one int
+    head = reader.payload[start:start + 9]
+    avail = (len(head) << 3) - (pos & 7)
+    window = int.from_bytes(head, 'big')
+    if pos + 4 > reader.end:
+        raise TruncatedPayload("ProtoN payload ended unexpectedly")
+    form = (window >> (avail - 4)) & 0xf
+    if form & 0x8:
+        end = pos + 65
+        if end > reader.end:
+            raise TruncatedPayload("ProtoN payload ended unexpectedly")
+        reader.pos = end
+        return unpack_float64(((window >> (avail - 65)) & bit_masks[64]).to_bytes(8, 'big'))[0]
+    # A ShortStr of at most 7 characters, which float() parses as bytes
+    width = (form & 0x7) << 3
+    end = pos + 4 + width
+    if end > reader.end:
+        raise TruncatedPayload("ProtoN payload ended unexpectedly")
+    reader.pos = end
+    return float(((window >> (avail - 4 - width)) & bit_masks[width]).to_bytes(width >> 3, 'big'))
+
+
+def unpack_boolean(reader):
+    """ Unpacks a boolean from the given reader
+    @param {BitReader} reader - reader positioned at boolean data to
+        unpack as per the spec in wire_protocol.md
+    """
+    return reader.read(1) == 1
 
 
-def unpack_boolean(payload):
-    """ Unpacks a boolean from the given payload and returns the remaining
-        subsequent payload
-    @param {bytes} payload - raw bytes at whose head is boolean data to
+def unpack_int(reader):
+    """ Unpacks an int from the given reader
+    @param {BitReader} reader - reader positioned at int data to
         unpack as per the spec in wire_protocol.md
     """
+    pos = reader.pos
+    start = pos >> 3
+    # The size and a value of up to 64 bits lie within the next 10 bytes,
+    # which are loaded as one int
+    head = reader.payload[start:start + 10]
+    avail = (len(head) << 3) - (pos & 7)
+    if pos + 2 > reader.end:
+        raise TruncatedPayload("ProtoN payload ended unexpectedly")
+    window = int.from_bytes(head, 'big')
+    sz = 8 << ((window >> (avail - 2)) & 0x3)
+    end = pos + 2 + sz
+    if end > reader.end:
+        raise TruncatedPayload("ProtoN payload ended unexpectedly")
+    reader.pos = end
+    num = (window >> (avail - 2 - sz)) & bit_masks[sz]
+    # Reinterpret the two's complement value as signed
+    if num >> (sz - 1):
+        num -= 1 << sz
+    return num
+
 
-    boolean_value, payload = payload.readlist(['bool', 'bits'])
-    return boolean_value, payload
+def unpack_varint(reader):
+    """ Unpacks an unsigned LEB128 varint, of at most 10 byte groups, from
+    the given reader
+    @param {BitReader} reader - reader positioned at the first byte group
+    """
+    pos = reader.pos
+    start = pos >> 3
+    # Load the next 11 bytes and shift them into line with the reader, so
+    # each byte group is a whole byte
+    head = reader.payload[start:start + 11]
+    size = len(head)
+    groups = ((int.from_bytes(head, 'big') << (pos & 7)) & bit_masks[size << 3]).to_bytes(size, 'big')
+    value = shift = 0
+    for end, group in enumerate(groups[:10], 1):
+        value |= (group & 0x7f) << shift
+        if group < 0x80:
+            end = pos + (end << 3)
+            if end > reader.end:
+                raise TruncatedPayload("ProtoN payload ended unexpectedly")
+            reader.pos = end
+            return value
+        shift += 7
+    if pos + 80 > reader.end:
+        raise TruncatedPayload("ProtoN payload ended unexpectedly")
+    raise ValueError("Varint longer than 10 bytes")
 
 
-def unpack_int(payload):
-    """ Unpacks an int from the given payload and returns the remaining
-        subsequent payload
-    @param {bytes} payload - raw bytes at whose head is int data to
+def unpack_zigzag(reader):
+    """ Unpacks an int sent as a zigzag varint from the given reader
+    @param {BitReader} reader - reader positioned at int data to
         unpack as per the spec in wire_protocol.md
     """
-    # Calculate the size of the int
-    sz, payload = payload.readlist(['uint:2', 'bits'])
-    sz = 2**(sz + 3)
-    int_fmt = 'int:' + str(sz)
+    value = unpack_varint(reader)
+    return (value >> 1) ^ -(value & 1)
 
-    num, payload = payload.readlist([int_fmt, 'bits'])
 
-    # Return the int and any remaining payload
-    return num, payload
+def unpack_null(reader):
+    """Unpacks null from the reader, which carries no data, and returns None"""
+    return None
 
 
-def unpack_null(payload):
-    """Unpacks null from start of payload and returns None and the payload"""
-    return None, payload
+def unpack_string(reader, short=False):
+    """Unpacks a string from the reader and returns it"""
+    length = unpack_len(reader, short)
+    return reader.read_string(length)
 
 
-def unpack_string(payload, short=False):
-    """Unpacks string and returns it along with the remaining payload"""
-    length, payload = unpack_len(payload, short)
-    # Slice the string and the remaining payload
-    string, payload = payload[:length*8].tobytes(), payload[length*8:]
-    # Return the decoded string and remianing bytes payload
-    return string.decode('utf-8'), payload
+def unpack_table_string(reader):
+    """ Unpacks a string value of a message with the string table: a flag
+    followed by either a string, which takes a free slot or that of the
+    least recently used string, or the slot of a recent string """
+    strings = reader.strings
+    if reader.read(1):
+        slot = reader.read(len(strings).bit_length())
+        if slot not in strings:
+            raise ValueError("String back-reference out of range. Got:", slot)
+        strings.move_to_end(slot)
+        return strings[slot]
+    value = unpack_string(reader)
+    if len(strings) < reader.string_table_size:
+        slot = len(strings)
+    else:
+        slot = strings.popitem(last=False)[0]
+    strings[slot] = value
+    return value
 
 
-def unpack_len(payload, short=False):
+def unpack_len(reader, short=False):
     """Unpacks a len-headed block of data, such as that which corresponds
     to a string, list, or dictionary."""
 
-    # Calculate the size of the number representing the lenght of the str`
-    # Slice the length of the string from the data and unpack it
+    # Read the size of the number representing the length, then the length
     if short:
-        length, payload = payload.readlist(['uint:3', 'bits'])
+        return reader.read(3)
+    if reader.flags & FLAG_VARINTS:
+        return unpack_varint(reader)
+    return reader.read(8 << reader.read(2))
+
+
+def unpack_extension(reader):
+    """ Unpacks a value of an extended type, whose TYPE_EXTENSION code has
+    already been read
+    @param {BitReader} reader - reader positioned at the extended type
+    """
+    ext = reader.read(3)
+    if ext == EXT_PACKED_ARRAY:
+        return unpack_packed_array(reader)
+    elif ext == EXT_CHUNKED_LIST:
+        return unpack_chunked_list(reader)
+    raise ValueError("Extended type not recognized. Got:", ext)
+
+
+def unpack_chunked_list(reader):
+    """ Unpacks a chunked list: chunks each made of a count followed by that
+    many values, ending with an empty chunk
+    @param {BitReader} reader - reader positioned at the first count
+    """
+    values = []
+    length = unpack_len(reader)
+    while length:
+        values.extend(decode_object(reader) for _ in range(length))
+        length = unpack_len(reader)
+    return values
+
+
+def unpack_packed_array(reader):
+    """ Unpacks a packed array: its element type, its length and, from the
+    next byte boundary, the raw big-endian elements
+    @param {BitReader} reader - reader positioned at the element type
+    """
+    packed_type = reader.read(3)
+    if packed_type not in packed_formats:
+        raise ValueError("Packed element type not recognized. Got:", packed_type)
+    length = unpack_len(reader)
+    reader.align()
+    start = reader.pos >> 3
+    reader.skip((length * packed_sizes[packed_type]) << 3)
+    if reader.arrays == 'numpy':
+        return numpy.frombuffer(reader.payload, packed_dtypes[packed_type],
+                                length, start)
+    values = array(packed_formats[packed_type])
+    values.frombytes(reader.payload[start:reader.pos >> 3])
+    if byteorder == 'little' and values.itemsize > 1:
+        values.byteswap()
+    return values if reader.arrays == 'array' else values.tolist()
+
+
+def skip_extension(reader):
+    """ Advances the reader past a value of an extended type, whose
+    TYPE_EXTENSION code has already been read """
+    ext = reader.read(3)
+    if ext == EXT_PACKED_ARRAY:
+        packed_type = reader.read(3)
+        if packed_type not in packed_sizes:
+            raise ValueError("Packed element type not recognized. Got:", packed_type)
+        length = unpack_len(reader)
+        reader.align()
+        reader.skip((length * packed_sizes[packed_type]) << 3)
+    elif ext == EXT_CHUNKED_LIST:
+        length = unpack_len(reader)
+        while length:
+            for _ in range(length):
+                skip_object(reader)
+            length = unpack_len(reader)
     else:
-        sz, payload = payload.readlist(['uint:2', 'bits'])
-        fmt_str = "uint:" + str(2**(sz+3))
-        length, payload = payload.readlist([fmt_str, 'bits'])
-    return length, payload
+        raise ValueError("Extended type not recognized. Got:", ext)
 
 
-def decode_pair(payload):
-    dtype, payload = unpack_dtype(payload)
-#     print('dtype_pair:', dtype)
+def unpack_key(reader):
+    """Unpacks the key of a pair, which is either a string or, with the key
+    table enabled, a flag followed by a string or a back-reference to a
+    previous key"""
+    keys = reader.keys
+    if keys is None:
+        cache = reader.key_cache
+        if cache is None:
+            return unpack_string(reader)
+        raw = reader.read_bytes(unpack_len(reader))
+        key = cache.get(raw)
+        if key is None:
+            key = raw.decode('utf-8')
+            if len(cache) < KEY_CACHE_SIZE:
+                cache[raw] = key
+        return key
+    if reader.read(1):
+        index = reader.read(len(keys).bit_length())
+        if index >= len(keys):
+            raise ValueError("Key back-reference out of range. Got:", index)
+        return keys[index]
+    key = unpack_string(reader)
+    keys.append(key)
+    return key
+
+
+def decode_pair(reader):
+    dtype = unpack_dtype(reader)
     assert(dtype == TYPE_PAIR)
-    key, payload = unpack_string(payload)
-    value, payload = decode_object(payload)
-    return key, value, payload
+    key = unpack_key(reader)
+    value = decode_object(reader)
+    return key, value
+
+
+def skip_object(reader):
+    """ Advances the reader past the object at its position without building
+    any Python values for it. Only dtypes and length prefixes are read, each
+    header through a single 16-bit window.
+    @param {BitReader} reader - reader positioned at the object's dtype
+    """
+    if reader.flags & UNPACKER_FLAGS:
+        skip_fields(reader)
+        return
+    payload = reader.payload
+    keys = reader.keys
+    pos = reader.pos
+    # [entries left, entries are pairs] of each open container
+    stack = []
+    while pos <= reader.end:
+        # Load the next 16 bits, zero-filled past the end of the payload
+        head = payload[pos >> 3:(pos >> 3) + 3]
+        window = int.from_bytes(head, 'big') << ((3 - len(head)) << 3)
+        window = (window >> (8 - (pos & 7))) & 0xffff
+        if stack and stack[-1][1]:
+            # Skip the pair's dtype and key, then read the value's header
+            if window >> 13 != TYPE_PAIR:
+                raise ValueError("Expected a pair dtype in object")
+            if keys is not None:
+                # New keys must still be recorded for later back-references
+                reader.pos = pos + 3
+                unpack_key(reader)
+                pos = reader.pos
+            elif window & 0x1800:
+                reader.pos = pos + 3
+                length = unpack_len(reader)
+                pos = reader.pos + (length << 3)
+            else:
+                pos += 13 + (((window >> 3) & 0xff) << 3)
+            head = payload[pos >> 3:(pos >> 3) + 3]
+            window = int.from_bytes(head, 'big') << ((3 - len(head)) << 3)
+            window = (window >> (8 - (pos & 7))) & 0xffff
+        dtype = window >> 13
+        length = 0
+        if dtype == TYPE_NULL:
+            pos += 3
+        elif dtype == TYPE_BOOL:
+            pos += 4
+        elif dtype == TYPE_INT:
+            pos += 5 + (8 << ((window >> 11) & 3))
+        elif dtype == TYPE_FLOAT:
+            if window & 0x1000:
+                pos += 68
+            else:
+                pos += 7 + (((window >> 9) & 7) << 3)
+        elif dtype == TYPE_EXTENSION:
+            reader.pos = pos + 3
+            skip_extension(reader)
+            pos = reader.pos
+        else:
+            # Strings and containers are followed by a len
+            if window & 0x1800:
+                reader.pos = pos + 3
+                length = unpack_len(reader)
+                pos = reader.pos
+            else:
+                length = (window >> 3) & 0xff
+                pos += 13
+            if dtype == TYPE_STRING:
+                pos += length << 3
+                length = 0
+        if length:
+            stack.append([length, dtype == TYPE_OBJECT])
+            continue
+        # Close every container completed by this value
+        while stack:
+            top = stack[-1]
+            top[0] -= 1
+            if top[0]:
+                break
+            stack.pop()
+        if not stack:
+            break
+    if pos > reader.end:
+        raise TruncatedPayload("ProtoN payload ended unexpectedly")
+    reader.pos = pos
+
+
+def skip_fields(reader):
+    """ Advances the reader past the object at its position, as skip_object
+    does, in a message whose ints and lengths are varints or whose strings
+    use the string table. Each field is read in turn, as each varint must
+    be read to find where it ends and each new string must be recorded.
+    @param {BitReader} reader - reader positioned at the object's dtype
+    """
+    read = reader.read
+    skip = reader.skip
+    keys = reader.keys
+    strings = reader.strings
+    varints = reader.flags & FLAG_VARINTS
+    # [entries left, entries are pairs] of each open container
+    stack = []
+    while True:
+        if stack and stack[-1][1]:
+            if read(3) != TYPE_PAIR:
+                raise ValueError("Expected a pair dtype in object")
+            if keys is not None:
+                # New keys must still be recorded for later back-references
+                unpack_key(reader)
+            else:
+                skip(unpack_len(reader) << 3)
+        dtype = read(3)
+        length = 0
+        if dtype == TYPE_BOOL:
+            skip(1)
+        elif dtype == TYPE_INT:
+            if varints:
+                unpack_varint(reader)
+            else:
+                skip(8 << read(2))
+        elif dtype == TYPE_FLOAT:
+            skip(64 if read(1) else read(3) << 3)
+        elif dtype == TYPE_STRING:
+            if strings is not None:
+                unpack_table_string(reader)
+            else:
+                skip(unpack_len(reader) << 3)
+        elif dtype == TYPE_EXTENSION:
+            skip_extension(reader)
+        elif dtype != TYPE_NULL:
+            length = unpack_len(reader)
+        if length:
+            stack.append([length, dtype == TYPE_OBJECT])
+            continue
+        # Close every container completed by this value
+        while stack:
+            top = stack[-1]
+            top[0] -= 1
+            if top[0]:
+                break
+            stack.pop()
+        if not stack:
+            return
+
+
+def compile_selection(paths):
+    """ Compiles selector paths into a tree of dicts keyed by UTF-8 encoded
+    object keys, list indices and WILDCARD. A None subtree selects the whole
+    value at that point.
+    @param {list} paths - paths such as "user.name" or "items[*].id"
+    """
+    selection = {}
+    for path in paths:
+        steps = []
+        pos = 0
+        while pos < len(path):
+            match = selector_step.match(path, pos)
+            if match is None:
+                raise ValueError("Malformed selector path. Got:", path)
+            key, index = match.groups()
+            if key is not None:
+                steps.append(key.encode('utf-8'))
+            elif index == '*':
+                steps.append(WILDCARD)
+            else:
+                steps.append(int(index))
+            pos = match.end()
+        if not steps:
+            raise ValueError("Malformed selector path. Got:", path)
+        node = selection
+        for step in steps[:-1]:
+            if step not in node:
+                node[step] = {}
+            node = node[step]
+            if node is None:
+                break
+        else:
+            node[steps[-1]] = None
+    return selection
+
+
+def merge_selections(first, second):
+    """ Returns the union of two compiled selections """
+    if first is None or second is None:
+        return None
+    merged = dict(first)
+    for step, node in second.items():
+        merged[step] = merge_selections(merged[step], node) if step in merged else node
+    return merged
+
+
+def decode_selected(reader, selection):
+    """ Decodes the parts of the object at the reader's position which are
+    listed in a compiled selection, skipping everything else. Returns
+    NOT_SELECTED if the object is a primitive that the selection descends
+    into, since it then has nothing to select.
+    @param {BitReader} reader - reader positioned at the object's dtype
+    @param {dict} selection - the compiled selection for this object
+    """
+    if selection is None:
+        return decode_object(reader)
+    start = reader.pos
+    dtype = unpack_dtype(reader)
+    if dtype == TYPE_OBJECT:
+        length = unpack_len(reader)
+        key_lengths = set(len(key) for key in selection if isinstance(key, bytes))
+        dict_obj = {}
+        for _ in range(length):
+            if unpack_dtype(reader) != TYPE_PAIR:
+                raise ValueError("Expected a pair dtype in object")
+            if reader.keys is not None:
+                key = unpack_key(reader).encode('utf-8')
+                if key in selection:
+                    value = decode_selected(reader, selection[key])
+                    if value is not NOT_SELECTED:
+                        dict_obj[key.decode('utf-8')] = value
+                else:
+                    skip_object(reader)
+                continue
+            key_length = unpack_len(reader)
+            if key_length not in key_lengths:
+                # No selected key is this long, so its bytes need not be read
+                reader.skip(key_length << 3)
+                skip_object(reader)
+                continue
+            key = reader.read_bytes(key_length)
+            if key not in selection:
+                skip_object(reader)
+                continue
+            value = decode_selected(reader, selection[key])
+            if value is not NOT_SELECTED:
+                dict_obj[key.decode('utf-8')] = value
+        return dict_obj
+    chunked = False
+    if dtype == TYPE_EXTENSION and reader.flags & FLAG_EXTENDED_TYPES:
+        chunked = unpack_dtype(reader) == EXT_CHUNKED_LIST
+    if dtype == TYPE_LIST or chunked:
+        if chunked and any(isinstance(step, int) and step < 0 for step in selection):
+            raise ValueError("Negative indices cannot select from a chunked list")
+        # A plain list is read as a single chunk of its whole length
+        length = None if chunked else unpack_len(reader)
+        count = unpack_len(reader) if chunked else length
+        every = selection.get(WILDCARD, NOT_SELECTED)
+        list_obj = []
+        i = 0
+        while count:
+            for i in range(i, i + count):
+                node = selection.get(i, NOT_SELECTED)
+                if node is NOT_SELECTED and length is not None:
+                    node = selection.get(i - length, NOT_SELECTED)
+                if every is not NOT_SELECTED:
+                    node = every if node is NOT_SELECTED else merge_selections(node, every)
+                if node is NOT_SELECTED:
+                    skip_object(reader)
+                    continue
+                value = decode_selected(reader, node)
+                if value is not NOT_SELECTED:
+                    list_obj.append(value)
+            i += 1
+            count = unpack_len(reader) if chunked else 0
+        return list_obj
+    elif dtype == TYPE_EXTENSION and reader.flags & FLAG_EXTENDED_TYPES:
+        reader.pos = start
+        values = decode_object(reader)
+        # Packed array elements are primitives, so can only be taken whole
+        length = len(values)
+        every = selection.get(WILDCARD, NOT_SELECTED) is None
+        return [values[i] for i in range(length) if every
+                or selection.get(i, selection.get(i - length, NOT_SELECTED)) is None]
+    else:
+        reader.pos = start
+        skip_object(reader)
+        return NOT_SELECTED
+
+
+# Unpack functions of each primitive dtype
+primitive_unpackers = {
+    TYPE_NULL: unpack_null,
+    TYPE_STRING: unpack_string,
+    TYPE_INT: unpack_int,
+    TYPE_BOOL: unpack_boolean,
+    TYPE_FLOAT: unpack_float,
+}
+# Extensions which change how primitives are unpacked
+UNPACKER_FLAGS = FLAG_VARINTS | FLAG_STRING_TABLE
+# Unpack functions of each primitive dtype, for each combination of those
+# extensions
+flag_unpackers = {}
+for flags in (0, FLAG_VARINTS, FLAG_STRING_TABLE, UNPACKER_FLAGS):
+    flag_unpackers[flags] = dict(primitive_unpackers)
+    if flags & FLAG_VARINTS:
+        flag_unpackers[flags][TYPE_INT] = unpack_zigzag
+    if flags & FLAG_STRING_TABLE:
+        flag_unpackers[flags][TYPE_STRING] = unpack_table_string
+
+
+class StreamDecoder(object):
+    """ Push-style decoder for ProtoN messages that arrive in pieces, such as
+    partial socket reads. Each call to feed() parses as far as the bytes
+    received so far allow. A field that straddles two chunks (even a 3-bit
+    opcode or a 2-bit length prefix) is left unread until the rest of it
+    arrives. Consecutive messages on one stream are decoded in turn. The
+    START_LIST event of a chunked list carries None, as its length is only
+    known once it ends. A compressed message is decompressed as it arrives
+    and its events are those of the message it holds.
+    @param {bool} values - if set, feed() returns completed top-level values
+        rather than (event, value) pairs
+    @param {bytes} dictionary - the preset dictionary of compressed messages
+    @param {int} max_size - longest message a compressed message may hold,
+        in bytes, or None for no limit; a longer one raises LimitExceeded
+    """
+
+    def __init__(self, values=False, dictionary=None, max_size=None):
+        self.values = values
+        self.dictionary = dictionary
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.pos = 0
+        self.expect = EXPECT_VERSION
+        # Extensions, key table and string table of the current message
+        self.flags = 0
+        self.keys = None
+        self.strings = None
+        self.string_table_size = 0
+        # [dtype, remaining entries, is chunked] of every open container,
+        # where the entries of a chunked list remain in its chunk
+        self.stack = []
+        # [container, pending key] of every container being built
+        self.building = []
+        self.output = []
+        # Decompressor, codec, decoder and bytes decompressed so far of the
+        # compressed message being read, and whether this decoder reads the
+        # single message held by another's
+        self.stream = None
+        self.codec = None
+        self.inner = None
+        self.size = 0
+        self.nested = False
+
+    def feed(self, chunk):
+        """ Consumes the next chunk of the stream and returns the events (or
+        values) that it completed """
+        self.buffer += chunk
+        reader = BitReader(self.buffer)
+        reader.flags = self.flags
+        reader.keys = self.keys
+        reader.strings = self.strings
+        reader.string_table_size = self.string_table_size
+        try:
+            while True:
+                # Fields are only committed to self.pos once fully read
+                reader.pos = self.pos
+                self.step(reader)
+        except TruncatedPayload:
+            pass
+        reader.release()
+        # Discard the bytes which have been parsed completely
+        del self.buffer[:self.pos >> 3]
+        self.pos &= 7
+        output, self.output = self.output, []
+        return output
+
+    def close(self):
+        """ Asserts that the stream did not end in the middle of a message """
+        if self.expect != EXPECT_VERSION or len(self.buffer) > (self.pos >> 3):
+            raise TruncatedPayload("ProtoN stream ended within a message")
+
+    def step(self, reader):
+        """ Reads one version, key or value from the reader """
+        if self.expect == EXPECT_VERSION:
+            self.flags = decode_header(reader)
+            self.keys = reader.keys
+            self.strings = reader.strings
+            self.string_table_size = reader.string_table_size
+            self.pos = reader.pos
+            if self.flags & FLAG_COMPRESSED:
+                if self.nested:
+                    raise ValueError("A compressed message holds another compressed message")
+                self.expect = EXPECT_CODEC
+            else:
+                self.expect = EXPECT_VALUE
+        elif self.expect == EXPECT_CODEC:
+            self.codec = reader.read(8)
+            self.stream = decompressor(self.codec, self.dictionary)
+            self.inner = StreamDecoder(self.values, self.dictionary)
+            self.size = 0
+            self.inner.nested = True
+            self.pos = reader.pos
+            self.expect = EXPECT_COMPRESSED
+        elif self.expect == EXPECT_COMPRESSED:
+            self.step_compressed(reader)
+        elif self.expect == EXPECT_END:
+            if reader.pos < reader.end:
+                raise ValueError("Compressed message continues after the message it holds")
+            raise TruncatedPayload("Compressed message is complete")
+        elif self.expect == EXPECT_PAIR:
+            dtype = unpack_dtype(reader)
+            if dtype != TYPE_PAIR:
+                raise ValueError("Expected a pair dtype. Got:", dtype)
+            key = unpack_key(reader)
+            self.pos = reader.pos
+            self.expect = EXPECT_VALUE
+            self.emit(KEY, key)
+        elif self.expect == EXPECT_CHUNK:
+            length = unpack_len(reader)
+            self.pos = reader.pos
+            if length:
+                self.stack[-1][1] = length
+                self.expect = EXPECT_VALUE
+                return
+            # The empty chunk ends the list, which is a value of its parent
+            self.stack.pop()
+            self.emit(END_LIST, None)
+            self.end_value()
+        else:
+            dtype = unpack_dtype(reader)
+            chunked = False
+            if dtype == TYPE_EXTENSION and self.flags & FLAG_EXTENDED_TYPES:
+                if reader.read(3) == EXT_CHUNKED_LIST:
+                    dtype, chunked = TYPE_LIST, True
+                else:
+                    reader.pos -= 3
+            if dtype == TYPE_LIST or dtype == TYPE_OBJECT:
+                length = unpack_len(reader)
+                self.pos = reader.pos
+                if dtype == TYPE_LIST:
+                    start, end, expect = START_LIST, END_LIST, EXPECT_VALUE
+                else:
+                    start, end, expect = START_OBJECT, END_OBJECT, EXPECT_PAIR
+                # The length of a chunked list is not known until it ends
+                self.emit(start, None if chunked else length)
+                if length:
+                    self.stack.append([dtype, length, chunked])
+                    self.expect = expect
+                    return
+                self.emit(end, None)
+            else:
+                if dtype == TYPE_EXTENSION and self.flags & FLAG_EXTENDED_TYPES:
+                    value = unpack_extension(reader)
+                else:
+                    value = unpack_primitive(reader, dtype)
+                self.pos = reader.pos
+                self.emit(VALUE, value)
+            self.end_value()
+
+    def step_compressed(self, reader):
+        """ Decompresses the bytes received of a compressed message and feeds
+        them to the decoder of the message it holds """
+        start = self.pos >> 3
+        data = bytes(reader.payload[start:])
+        if not data:
+            raise TruncatedPayload("ProtoN stream ended within a compressed message")
+        limit = None if self.max_size is None else self.max_size - self.size
+        try:
+            message = decompress_more(self.stream, self.codec, data, limit)
+        except codec_errors as error:
+            raise ValueError("Malformed compressed message:", error)
+        if message is None:
+            raise LimitExceeded("Compressed message holds more bytes than the limit")
+        self.size += len(message)
+        self.output += self.inner.feed(message)
+        if not self.stream.eof:
+            self.pos = reader.end
+            return
+        # Bytes after the compressed stream belong to the next message
+        self.pos = (start + len(data) - len(self.stream.unused_data)) << 3
+        if self.inner.expect != EXPECT_END:
+            raise ValueError("Compressed message ended within the message it holds")
+        self.stream = self.inner = None
+        self.expect = EXPECT_VERSION
+
+    def end_value(self):
+        """ Closes every container completed by the value just read """
+        stack = self.stack
+        while stack:
+            top = stack[-1]
+            top[1] -= 1
+            if top[1]:
+                self.expect = EXPECT_PAIR if top[0] == TYPE_OBJECT else EXPECT_VALUE
+                return
+            if top[2]:
+                # A chunked list goes on to its next chunk
+                self.expect = EXPECT_CHUNK
+                return
+            stack.pop()
+            self.emit(END_OBJECT if top[0] == TYPE_OBJECT else END_LIST, None)
+        # The message is complete; the next one starts on a byte boundary
+        self.pos = (self.pos + 7) & ~7
+        self.expect = EXPECT_END if self.nested else EXPECT_VERSION
+
+    def emit(self, event, value):
+        if not self.values:
+            self.output.append((event, value))
+            return
+        building = self.building
+        if event == START_OBJECT:
+            building.append([{}, None])
+            return
+        elif event == START_LIST:
+            building.append([[], None])
+            return
+        elif event == KEY:
+            building[-1][1] = value
+            return
+        elif event == END_OBJECT or event == END_LIST:
+            value = building.pop()[0]
+        if building:
+            parent, key = building[-1]
+            if key is None:
+                parent.append(value)
+            else:
+                parent[key] = value
+        else:
+            self.output.append(value)
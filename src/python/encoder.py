@@ -1,129 +1,1000 @@
 #! /usr/env python
 
 from constants import *
-from struct import pack, unpack, calcsize
-from collections import Mapping, Set, Sequence
-from bitstring import BitStream, Bits
+from struct import pack, Struct
+from array import array
+from sys import byteorder
+from os import cpu_count
+from itertools import repeat, islice
+from operator import attrgetter
+from dataclasses import is_dataclass, fields as dataclass_fields
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator, Mapping, MappingView, Set, Sequence
+from concurrent.futures import Executor, ProcessPoolExecutor
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 string_types = (str, bytes)
 primitive_types = (int, str, float, bool, type(None))
 
+# Number of pending bits after which the accumulator is drained to the buffer
+ACCUMULATOR_BITS = 64
+# Default number of bytes encode_to() collects before writing them out
+BUFFER_SIZE = 2**16
+# Shortest list or tuple which is checked for packing into a packed array
+PACKED_MIN_LENGTH = 8
+# Number of chunks of children handed to each worker of a parallel encode
+CHUNKS_PER_WORKER = 4
+# Number of elements of an iterator collected into each chunk of a chunked list
+CHUNK_SIZE = 2**10
+# Most keys an Encoder keeps pre-encoded between messages
+KEY_CACHE_SIZE = 2**12
+# Default number of recent string values kept for back-references by the
+# string table
+STRING_TABLE_SIZE = 2**8
 
-def pack_message(bytelist):
-    bytelist.insert(0, BitStream(uint=PROTOCOL_VERSION, length=2))
+# Packed element type of each signed int width, and of each array typecode
+packed_int_types = {1: PACKED_INT8, 2: PACKED_INT16, 4: PACKED_INT32, 8: PACKED_INT64}
+packed_typecodes = dict((tc, packed_int_types[array(tc).itemsize]) for tc in 'bhilq')
+packed_typecodes.update({'B': PACKED_UINT8, 'f': PACKED_FLOAT32, 'd': PACKED_FLOAT64})
+# array typecode of each signed int width
+int_typecodes = dict((array(tc).itemsize, tc) for tc in 'bhilq')
 
-    return Bits().join(bytelist).tobytes()
+# Numeric codecs, choosing how floats are sent
+FLOATS_SHORTEST = 'shortest'
+FLOATS_FLOAT64 = 'float64'
+# Header bits, total width and value mask of an int, by its magnitude's bit length
+int_formats = [((((TYPE_INT << 2) | sz) << width), 5 + width, (1 << width) - 1)
+               for sz, width in [(0, 8)] * 8 + [(1, 16)] * 8 + [(2, 32)] * 16 + [(3, 64)] * 32]
+# Header bits (dtype, flag and length) and total width of a float sent as a
+# ShortStr, by the length of its repr
+short_float_formats = [(((TYPE_FLOAT << 4) | length) << (length << 3), 7 + (length << 3))
+                       for length in range(8)]
+FLOAT64_HEADER = ((TYPE_FLOAT << 1) | 1) << 64
+pack_float64 = Struct('>d').pack
 
+# Kinds of children encode_object iterates over for each open container
+CHILD_VALUES = 0  # elements of a list
+CHILD_PAIRS = 1  # (key, value) pairs of a mapping
+CHILD_FIELDS = 2  # (pre-encoded key, value) pairs of an object with a plan
+# Plan of each custom class, or False for classes without fixed fields
+class_plans = {}
 
-def encode_key(data):
+
+class BitWriter(object):
+    """ Writes big-endian bit fields into a single growable bytearray.
+    Fields are shifted into an integer accumulator, which is drained to the
+    buffer a whole byte at a time once it holds at least 64 bits, so no
+    intermediate objects are built per field.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.acc = 0
+        self.nbits = 0
+        # Index of every key sent so far, when the key table is enabled
+        self.keys = None
+        # Whether numeric sequences are sent as packed arrays, and iterators
+        # as chunked lists
+        self.packed_arrays = False
+        self.chunked_lists = False
+        # Pair header and key bits of keys already seen, kept across messages
+        # by an Encoder, or None
+        self.key_cache = None
+        # Encoder of each primitive type, as chosen by the numeric codec
+        self.encoders = None
+        # Whether lengths are sent as varints
+        self.varints = False
+        # Slot of each recent string value, least recently used first, when
+        # the string table is enabled, and the number of slots
+        self.strings = None
+        self.string_table_size = 0
+
+    def write(self, value, width):
+        """ Appends the low `width` bits of the unsigned int `value` """
+        self.acc = (self.acc << width) | value
+        self.nbits += width
+        if self.nbits >= ACCUMULATOR_BITS:
+            self.drain()
+
+    def write_bytes(self, data):
+        """ Appends raw bytes at the current (possibly unaligned) bit offset """
+        if self.nbits:
+            width = len(data) << 3
+            self.acc = (self.acc << width) | int.from_bytes(data, 'big')
+            self.nbits += width
+            self.drain()
+        else:
+            self.buffer += data
+
+    def drain(self):
+        """ Moves every complete byte held in the accumulator to the buffer """
+        nbytes = self.nbits >> 3
+        if nbytes:
+            rem = self.nbits & 7
+            self.buffer += (self.acc >> rem).to_bytes(nbytes, 'big')
+            self.acc &= (1 << rem) - 1
+            self.nbits = rem
+
+    def write_fragment(self, data, nbits):
+        """ Appends the first `nbits` bits of `data`, such as a fragment
+        encoded by another writer, at the current bit offset """
+        whole = nbits >> 3
+        self.write_bytes(data[:whole])
+        if nbits & 7:
+            self.write(data[whole] >> (8 - (nbits & 7)), nbits & 7)
+
+    def align(self):
+        """ Zero-pads the output to the next byte boundary """
+        if self.nbits & 7:
+            self.write(0, 8 - (self.nbits & 7))
+        self.drain()
+
+    def bit_length(self):
+        """ Returns the number of bits written so far """
+        return (len(self.buffer) << 3) + self.nbits
+
+    def getvalue(self):
+        """ Returns the written bits as bytes, zero-padding the last byte """
+        self.drain()
+        if self.nbits:
+            return bytes(self.buffer) + bytes([self.acc << (8 - self.nbits)])
+        return bytes(self.buffer)
+
+
+class StreamWriter(BitWriter):
+    """ BitWriter which hands its completed bytes to a writable object (a
+    file, socket wrapper, etc.) once at least `buffer_size` of them have
+    accumulated. Bits of an unfinished byte stay in the accumulator and are
+    carried over to the next write.
+    @param writable - object with a `write` method accepting bytes
+    @param {int} buffer_size - number of bytes to collect before writing
+    """
+
+    def __init__(self, writable, buffer_size=BUFFER_SIZE):
+        BitWriter.__init__(self)
+        self.writable = writable
+        self.buffer_size = buffer_size
+        self.written = 0
+
+    def write_bytes(self, data):
+        BitWriter.write_bytes(self, data)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def drain(self):
+        BitWriter.drain(self)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ Writes out every complete byte held in the buffer """
+        if self.buffer:
+            self.writable.write(bytes(self.buffer))
+            self.written += len(self.buffer)
+            del self.buffer[:]
+
+    def bit_length(self):
+        return (self.written << 3) + BitWriter.bit_length(self)
+
+    def close(self):
+        """ Writes out the remaining bits, zero-padding the last byte, and
+        returns the total number of bytes written """
+        BitWriter.drain(self)
+        if self.nbits:
+            self.buffer.append((self.acc << (8 - self.nbits)) & 0xff)
+            self.acc = 0
+            self.nbits = 0
+        self.flush()
+        return self.written
+
+
+def pack_message(writer):
+    return writer.getvalue()
+
+
+def pack_header(writer, flags=0, string_table_size=STRING_TABLE_SIZE):
+    """ Writes the version which opens a message. Messages using any
+    extension are version 2 and list the extensions in a uint6 of flags,
+    followed by the size of the string table if it is enabled.
+    @param {BitWriter} writer - the bit writer to append to
+    @param {int} flags - the FLAG_* extensions used by the message
+    @param {int} string_table_size - the number of string table slots
+    """
+    if flags:
+        writer.write((PROTOCOL_VERSION << 6) | flags, 8)
+    else:
+        writer.write(BASE_PROTOCOL_VERSION, 2)
+    writer.keys = {} if flags & FLAG_KEY_TABLE else None
+    writer.varints = bool(flags & FLAG_VARINTS)
+    if flags & FLAG_STRING_TABLE:
+        if string_table_size < 1:
+            raise ValueError("The string table needs at least one slot. Got:", string_table_size)
+        pack_len(string_table_size, writer)
+        writer.strings = OrderedDict()
+        writer.string_table_size = string_table_size
+    else:
+        writer.strings = None
+
+
+def encode_key(data, writer):
+    keys = writer.keys
+    if keys is not None:
+        # Send a back-reference to a known key, sized by the table length
+        width = len(keys).bit_length()
+        if data in keys:
+            writer.write((1 << width) | keys[data], width + 1)
+            return
+        keys[data] = len(keys)
+        pack_bool(False, writer)
+    utf = data.encode('utf-8')
+    pack_len(len(utf), writer)
+    writer.write_bytes(utf)
+
+
+def pair_key_bits(key, varints=False):
+    """ Returns the bits of a pair dtype and key, as encode_object writes
+    them without the key table, as an int along with its width """
+    writer = BitWriter()
+    writer.varints = varints
+    utf = key.encode('utf-8')
+    pack_type(TYPE_PAIR, writer)
+    pack_len(len(utf), writer)
+    writer.write_bytes(utf)
+    width = writer.bit_length()
+    return int.from_bytes(writer.getvalue(), 'big') >> (-width & 7), width
+
+
+def class_slots(cls):
+    """ Returns the names of the slots of a class and its bases, base
+    classes first, and whether its instances also have a __dict__ """
+    names = []
+    for base in reversed(cls.__mro__):
+        slots = vars(base).get('__slots__', ())
+        for name in [slots] if isinstance(slots, str) else slots:
+            if name not in ('__dict__', '__weakref__'):
+                if name.startswith('__') and not name.endswith('__'):
+                    name = '_' + base.__name__.lstrip('_') + name
+                if name not in names:
+                    names.append(name)
+    return names, any('__dict__' in vars(base) for base in cls.__mro__)
+
+
+def class_plan(cls):
+    """ Inspects a class the first time one of its instances is encoded and
+    caches its plan: the names of its fields, a getter returning all of
+    their values at once, the pair header and key of each field encoded
+    ahead of time, and how many of the fields are kept in each instance's
+    __dict__. Dataclasses and attrs classes are encoded by their declared
+    fields and other classes by their slots. Classes with neither are
+    given no plan (False) and their instances are encoded through vars().
+    @param {type} cls - the class to inspect
+    """
+    slots, has_dict = class_slots(cls)
+    if is_dataclass(cls):
+        names = [field.name for field in dataclass_fields(cls)]
+    elif hasattr(cls, '__attrs_attrs__'):
+        names = [attribute.name for attribute in cls.__attrs_attrs__]
+    elif slots:
+        names = slots
+    else:
+        class_plans[cls] = False
+        return False
+    if len(names) > 1:
+        getter = attrgetter(*names)
+    elif names:
+        getter = lambda obj, get=attrgetter(names[0]): (get(obj),)
+    else:
+        getter = lambda obj: ()
+    in_dict = len([name for name in names if name not in slots]) if has_dict else -1
+    plan = (names, getter, [pair_key_bits(name) for name in names], in_dict)
+    class_plans[cls] = plan
+    return plan
+
+
+def object_fields(obj, plan):
+    """ Returns the fields of an object as a dict: those of its plan which
+    are set, followed by the rest of its __dict__ """
+    fields = {}
+    if plan:
+        for name in plan[0]:
+            value = getattr(obj, name, fields)
+            if value is not fields:
+                fields[name] = value
+    if hasattr(obj, '__dict__'):
+        fields.update(vars(obj))
+    elif not plan:
+        raise TypeError("Wire protocol does not support this data type. Got:", type(obj))
+    return fields
+
+
+def packed_form(obj):
+    """ Returns the packed element type, length and big-endian element bytes
+    of a homogeneous numeric sequence, or None if it cannot be packed.
+    array.array and NumPy arrays are converted without iterating in Python.
+    @param obj - a list, tuple, array.array or one dimensional ndarray
+    """
+    if isinstance(obj, array):
+        packed_type = packed_typecodes.get(obj.typecode)
+        if packed_type is None:
+            return None
+        values = obj
+    elif numpy is not None and isinstance(obj, numpy.ndarray):
+        kind, size = obj.dtype.kind, obj.dtype.itemsize
+        if obj.ndim != 1:
+            return None
+        elif kind == 'i':
+            packed_type = packed_int_types.get(size)
+        elif kind == 'u' and size == 1:
+            packed_type = PACKED_UINT8
+        elif kind == 'f' and size in (4, 8):
+            packed_type = PACKED_FLOAT32 if size == 4 else PACKED_FLOAT64
+        else:
+            return None
+        if packed_type is None:
+            return None
+        big_endian = obj.astype(obj.dtype.newbyteorder('>'), copy=False)
+        return packed_type, len(obj), big_endian.tobytes()
+    elif isinstance(obj, (list, tuple)) and len(obj) >= PACKED_MIN_LENGTH:
+        cls = type(obj[0])
+        if cls is not float and cls is not int:
+            return None
+        elif not all(type(elt) is cls for elt in obj):
+            return None
+        elif cls is float:
+            packed_type = PACKED_FLOAT64
+            values = array('d', obj)
+        else:
+            low, high = min(obj), max(obj)
+            for size in sorted(packed_int_types):
+                if -2**(8*size - 1) <= low and high < 2**(8*size - 1):
+                    break
+            else:
+                return None
+            packed_type = packed_int_types[size]
+            values = array(int_typecodes[size], obj)
+    else:
+        return None
+    if byteorder == 'little' and values.itemsize > 1:
+        values = values[:]
+        values.byteswap()
+    return packed_type, len(values), values.tobytes()
+
+
+def pack_array(obj, writer):
+    """ Writes obj as a packed array: the element type and count followed,
+    from the next byte boundary, by the raw big-endian elements. Returns
+    False, writing nothing, if obj is not a homogeneous numeric sequence.
+    @param obj - the sequence to pack
+    @param {BitWriter} writer - the bit writer to append to
+    """
+    form = packed_form(obj)
+    if form is None:
+        return False
+    packed_type, length, raw = form
+    writer.write((TYPE_EXTENSION << 6) | (EXT_PACKED_ARRAY << 3) | packed_type, 9)
+    pack_len(length, writer)
+    writer.align()
+    writer.write_bytes(raw)
+    return True
+
+
+def chunked_elements(iterator, writer):
+    """ Yields the elements of an iterator a chunk at a time. The count of
+    each chunk is written as its first element is asked for, which is once
+    every element before it has been encoded, and an empty chunk is written
+    once the iterator is exhausted.
+    @param iterator - the iterator sent as a chunked list
+    @param {BitWriter} writer - the bit writer to append to
+    """
+    while True:
+        chunk = list(islice(iterator, CHUNK_SIZE))
+        pack_len(len(chunk), writer)
+        if not chunk:
+            return
+        yield from chunk
+
+
+def encode_null(data, writer):
+    writer.write(TYPE_NULL, 3)
+
+
+def encode_bool(data, writer):
+    writer.write((TYPE_BOOL << 1) | data, 4)
+
+
+def encode_string(data, writer):
+    strings = writer.strings
+    if strings is not None:
+        # Send a back-reference to a recent string, sized by the table length
+        width = len(strings).bit_length()
+        slot = strings.get(data)
+        if slot is not None:
+            strings.move_to_end(data)
+            writer.write((((TYPE_STRING << 1) | 1) << width) | slot, width + 4)
+            return
+        # Otherwise the string takes a free slot, or that of the least
+        # recently used string
+        if len(strings) < writer.string_table_size:
+            slot = len(strings)
+        else:
+            slot = strings.popitem(last=False)[1]
+        strings[data] = slot
+        writer.write(TYPE_STRING << 1, 4)
+        utf = data.encode('utf-8')
+        pack_len(len(utf), writer)
+        writer.write_bytes(utf)
+        return
     utf = data.encode('utf-8')
-    utflen = len(utf)
-    return pack_len(utflen) + utf
+    pack_type(TYPE_STRING, writer)
+    pack_len(len(utf), writer)
+    writer.write_bytes(utf)
+
+
+def encode_int(data, writer):
+    """ Writes an int's dtype, size and value in a single write. Its size
+    is looked up by the bit length of its magnitude. """
+    try:
+        header, width, mask = int_formats[(data if data >= 0 else -data).bit_length()]
+    except IndexError:
+        raise ValueError("int values outside +/- 2**63 are not supported.")
+    writer.write(header | (data & mask), width)
+
+
+def encode_zigzag(data, writer):
+    """ Writes an int's dtype and value as a zigzag varint, so that ints of
+    small magnitude take a single byte group whatever their sign """
+    zigzag = data << 1 if data >= 0 else (~data << 1) | 1
+    if zigzag < 0x80:
+        writer.write((TYPE_INT << 8) | zigzag, 11)
+        return
+    if zigzag >> 64:
+        raise ValueError("int values outside +/- 2**63 are not supported.")
+    bits, width = varint_bits(zigzag)
+    writer.write((TYPE_INT << width) | bits, width + 3)
+
+
+def encode_float(data, writer):
+    """ Writes a float as a ShortStr if its shortest repr is under 8
+    characters and as a float64 otherwise, each in a single write """
+    float_str = repr(data)
+    if len(float_str) < 8:
+        header, width = short_float_formats[len(float_str)]
+        writer.write(header | int.from_bytes(float_str.encode(), 'big'), width)
+    else:
+        writer.write(FLOAT64_HEADER | int.from_bytes(pack_float64(data), 'big'), 68)
+
 
+def encode_float64(data, writer):
+    """ Writes a float as a float64 without checking its repr, which is
+    faster but larger for floats with short reprs """
+    writer.write(FLOAT64_HEADER | int.from_bytes(pack_float64(data), 'big'), 68)
 
-def encode_variable(data):
-    """Infers the type of data, then packs it into a network-order
-    bytestring in accordance with the wire protocol. Data must be of type:
+
+# Encoder of each primitive type, looked up by exact type
+variable_encoders = {
+    type(None): encode_null,
+    bool: encode_bool,
+    str: encode_string,
+    int: encode_int,
+    float: encode_float,
+}
+# Primitive encoders of each numeric codec. FLOATS_SHORTEST sends a float as
+# a ShortStr when its repr is short enough, and FLOATS_FLOAT64 always sends
+# a float64, skipping repr()
+numeric_codecs = {
+    FLOATS_SHORTEST: variable_encoders,
+    FLOATS_FLOAT64: dict(variable_encoders),
+}
+numeric_codecs[FLOATS_FLOAT64][float] = encode_float64
+# Primitive encoders of each numeric codec with FLAG_VARINTS, which sends
+# ints as zigzag varints
+varint_codecs = dict((floats, dict(encoders)) for floats, encoders in numeric_codecs.items())
+for encoders in varint_codecs.values():
+    encoders[int] = encode_zigzag
+
+
+def encode_variable(data, writer):
+    """Infers the type of data, then packs it into the writer in
+    accordance with the wire protocol. Data must be of type:
     int, str, float, boolean, None.
-    @param data - the data to pack"""
-    if data is None:
-        #         print('packing null')
-        return pack_type(TYPE_NULL)
+    @param data - the data to pack
+    @param {BitWriter} writer - the bit writer to append to"""
+    # Subclasses, such as IntEnum, are sent by the message's codec for their
+    # base type, as plain values
+    encoders = writer.encoders or variable_encoders
+    encoder = encoders.get(type(data))
+    if encoder is not None:
+        encoder(data, writer)
     elif isinstance(data, bool):
-        #         print('packing bool')
-        return pack_type(TYPE_BOOL) + pack_bool(data)
+        encoders[bool](data, writer)
     elif isinstance(data, str):
-        #         print('packing string')
-        utf = data.encode('utf-8')
-        utflen = len(utf)
-        return pack_type(TYPE_STRING) + pack_len(utflen) + utf
+        encoders[str](data, writer)
     elif isinstance(data, int):
-        #         print('packing int')
-        if abs(data) <= (2**7 - 1):
-            return pack_type(TYPE_INT) + BitStream(uint=0, length=2) + BitStream(int=data, length=8)
-        elif abs(data) <= (2**15 - 1):
-            return pack_type(TYPE_INT) + BitStream(uint=1, length=2) + BitStream(int=data, length=16)
-        elif abs(data) <= (2**31 - 1):
-            return pack_type(TYPE_INT) + BitStream(uint=2, length=2) + BitStream(int=data, length=32)
-        elif abs(data) <= (2**63 - 1):
-            return pack_type(TYPE_INT) + BitStream(uint=3, length=2) + BitStream(int=data, length=64)
-        else:
-            raise ValueError("int values outside +/- 2**63 are not supported.")
+        encoders[int](int(data), writer)
     elif isinstance(data, float):
-        if len(str(data)) < 8:
-            utf = str(data).encode('utf-8')
-            utflen = len(utf)
-            assert(utflen < 8)
-            return pack_type(TYPE_FLOAT) + pack_bool(False) + pack_len(utflen, short=True) + utf
-        else:
-            return pack_type(TYPE_FLOAT) + pack_bool(True) + BitStream(float=data, length=64)
-
+        encoders[float](float(data), writer)
     else:
         raise TypeError("Wire protocol does not support this data type. \
         Expected: int, str, float, None. Got:", type(data))
 
 
-def encode_object(obj, bytelist, memo=None):
+def encode_object(obj, writer, memo=None):
+    """ Encodes obj and everything nested within it into the writer. Open
+    containers are kept on an explicit stack rather than the call stack, so
+    nesting depth is not bounded by the recursion limit.
+    @param obj - the object to encode
+    @param {BitWriter} writer - the bit writer to append to
+    @param {set} memo - ids of the containers currently being encoded
+    """
     if memo is None:
         memo = set()
 
-    if isinstance(obj, primitive_types):
-        encoding = encode_variable(obj)
-        bytelist.append(encoding)
-    elif isinstance(obj, Mapping):
-        if id(obj) not in memo:
-            memo.add(id(obj))
+    write = writer.write
+    write_bytes = writer.write_bytes
+    encoders = writer.encoders or variable_encoders
+    keys = writer.keys
+    key_cache = writer.key_cache
+    packed_arrays = writer.packed_arrays
+    chunked_lists = writer.chunked_lists
+    varints = writer.varints
+    # Lengths below `short` are written in one go along with their dtype
+    short, shift = (0x80, 8) if varints else (2**8-1, 10)
+    # (remaining children, kind of children, container id) of each open container
+    stack = []
+    # Instance whose fields dict is encoded next, which stands in for the
+    # dict in the memo, as each pass over an instance builds a new dict
+    instance = None
+    while True:
+        cls = type(obj)
+        if cls in encoders:
+            encoders[cls](obj, writer)
+        elif isinstance(obj, primitive_types):
+            encode_variable(obj, writer)
         else:
-            raise ValueError(
-                "ProtoN does not support circular references within objects")
-        bytelist.extend([pack_type(TYPE_OBJECT), pack_len(len(obj.items()))])
-        for key, value in obj.items():
-            assert(isinstance(key, str))
-            bytelist.append(pack_type(TYPE_PAIR))
-            bytelist.append(encode_key(key))
-            encode_object(value, bytelist, memo)
-        memo.remove(id(obj))
-    elif isinstance(obj, (Sequence, Set)) and not isinstance(obj, string_types):
-        if id(obj) not in memo:
-            memo.add(id(obj))
+            # Classes met before skip straight to their plan, or to vars()
+            plan = None if cls is dict or cls is list else class_plans.get(cls)
+            if plan is not None:
+                pass
+            elif cls is dict or (cls is not list and isinstance(obj, Mapping)):
+                dtype, children, kind = TYPE_OBJECT, iter(obj.items()), CHILD_PAIRS
+                length = len(obj)
+            elif cls is list or (isinstance(obj, (Sequence, Set))
+                                 and not isinstance(obj, string_types)):
+                dtype, children, kind = TYPE_LIST, iter(obj), CHILD_VALUES
+                length = len(obj)
+                if packed_arrays and pack_array(obj, writer):
+                    children = None
+            elif numpy is not None and isinstance(obj, numpy.ndarray):
+                if packed_arrays and pack_array(obj, writer):
+                    children = None
+                else:
+                    # Rows of a multidimensional array may still be packed
+                    obj = list(obj) if packed_arrays and obj.ndim > 1 else obj.tolist()
+                    continue
+            elif isinstance(obj, Iterable):
+                # Iterators, dict views and any other iterable are lists
+                if not chunked_lists:
+                    # The length of a plain list is needed before its elements
+                    obj = list(obj)
+                    continue
+                write((TYPE_EXTENSION << 3) | EXT_CHUNKED_LIST, 6)
+                dtype, children, kind = None, chunked_elements(iter(obj), writer), CHILD_VALUES
+            else:
+                plan = class_plan(cls)
+            if plan is not None:
+                values = None
+                if plan:
+                    names, getter, key_bits, in_dict = plan
+                    try:
+                        values = getter(obj)
+                    except AttributeError:
+                        pass
+                    # Attributes set beyond the plan's fields need the slow path
+                    if in_dict >= 0 and len(obj.__dict__) != in_dict:
+                        values = None
+                if values is None:
+                    instance = obj
+                    obj = object_fields(obj, plan)
+                    continue
+                dtype, length = TYPE_OBJECT, len(values)
+                if keys is not None or varints:
+                    children, kind = zip(names, values), CHILD_PAIRS
+                else:
+                    children, kind = zip(key_bits, values), CHILD_FIELDS
+            if children is not None:
+                obj_id = id(obj if instance is None else instance)
+                instance = None
+                if obj_id not in memo:
+                    memo.add(obj_id)
+                else:
+                    raise ValueError(
+                        "ProtoN does not support circular references within objects")
+                # Chunked lists have written their header already
+                if dtype is None:
+                    pass
+                elif length < short:
+                    write((dtype << shift) | length, shift + 3)
+                else:
+                    pack_type(dtype, writer)
+                    pack_len(length, writer)
+                stack.append((children, kind, obj_id))
+
+        # Move on to the next child of the innermost unfinished container
+        while stack:
+            children, kind, obj_id = stack[-1]
+            child = next(children, stack)
+            if child is stack:
+                stack.pop()
+                memo.remove(obj_id)
+                continue
+            if kind == CHILD_FIELDS:
+                key, child = child
+                write(key[0], key[1])
+            elif kind:
+                key, child = child
+                assert(isinstance(key, str))
+                if keys is not None:
+                    pack_type(TYPE_PAIR, writer)
+                    encode_key(key, writer)
+                elif key_cache is not None and key in key_cache:
+                    bits = key_cache[key]
+                    write(bits[0], bits[1])
+                else:
+                    if key_cache is not None and len(key_cache) < KEY_CACHE_SIZE:
+                        key_cache[key] = pair_key_bits(key, varints)
+                    utf = key.encode('utf-8')
+                    if len(utf) < short:
+                        write((TYPE_PAIR << shift) | len(utf), shift + 3)
+                    else:
+                        pack_type(TYPE_PAIR, writer)
+                        pack_len(len(utf), writer)
+                    write_bytes(utf)
+            # Primitives are written without going back through the type checks
+            encoder = encoders.get(child.__class__)
+            if encoder is not None:
+                encoder(child, writer)
+                continue
+            obj = child
+            break
         else:
-            raise ValueError(
-                "ProtoN does not support circular references within objects")
-        bytelist.extend([pack_type(TYPE_LIST), pack_len(len(obj))])
-        for elt in obj:
-            encode_object(elt, bytelist, memo)
-        memo.remove(id(obj))
+            return
 
-    elif hasattr(obj, '__dict__'):
-        encode_object(vars(obj), bytelist)
+
+def encode_fragment(children, is_mapping, packed_arrays=False, encoders=None,
+                    varints=False):
+    """ Encodes a run of children of a container on their own, as each worker
+    of a parallel encode does. Returns the exact length of the fragment in
+    bits along with its bytes, whose last byte is zero-padded.
+    @param {list} children - the elements, or (key, value) pairs, to encode
+    @param {bool} is_mapping - whether the children are (key, value) pairs
+    @param {bool} packed_arrays - send numeric sequences as packed arrays
+    @param {dict} encoders - the primitive encoders of the numeric codec
+    @param {bool} varints - send lengths as varints
+    """
+    writer = BitWriter()
+    writer.packed_arrays = packed_arrays
+    writer.encoders = encoders
+    writer.varints = varints
+    memo = set()
+    for child in children:
+        if is_mapping:
+            key, child = child
+            assert(isinstance(key, str))
+            pack_type(TYPE_PAIR, writer)
+            encode_key(key, writer)
+        encode_object(child, writer, memo)
+    return writer.bit_length(), writer.getvalue()
 
 
-def pack_type(dtype):
-    return BitStream(uint=dtype, length=3)
+def collect_child(value):
+    """ Returns an iterator or dict view as a list, as it cannot be sent to a
+    worker process, and a serial encode without chunked lists collects it
+    anyway """
+    return list(value) if isinstance(value, (Iterator, MappingView)) else value
 
 
-def pack_len(length, short=False):
+def encode_parallel(data, writer, workers):
+    """ Encodes data, splitting the children of a top-level list or object
+    into chunks which are encoded by a pool of processes. The fragments are
+    joined in order at whatever bit offset each one starts, so the output is
+    identical to a serial encode.
+    @param data - the object to encode
+    @param {BitWriter} writer - the bit writer to append to
+    @param workers - number of worker processes, or an Executor to use
+    """
+    if writer.packed_arrays and pack_array(data, writer):
+        return
+    if isinstance(data, Mapping):
+        dtype = TYPE_OBJECT
+        children = [(key, collect_child(value)) for key, value in data.items()]
+    elif isinstance(data, (Sequence, Set)) and not isinstance(data, string_types):
+        dtype = TYPE_LIST
+        children = [collect_child(child) for child in data]
+    else:
+        encode_object(data, writer)
+        return
+    pack_type(dtype, writer)
+    pack_len(len(children), writer)
+
+    if isinstance(workers, Executor):
+        executor, count = workers, cpu_count() or 1
+    else:
+        executor, count = ProcessPoolExecutor(workers), workers
+    size = max(1, len(children) // (count * CHUNKS_PER_WORKER))
+    chunks = [children[i:i + size] for i in range(0, len(children), size)]
+    try:
+        fragments = executor.map(encode_fragment, chunks,
+                                 repeat(dtype == TYPE_OBJECT),
+                                 repeat(writer.packed_arrays),
+                                 repeat(writer.encoders),
+                                 repeat(writer.varints))
+        for nbits, fragment in fragments:
+            writer.write_fragment(fragment, nbits)
+    finally:
+        if executor is not workers:
+            executor.shutdown()
+
+
+def pack_type(dtype, writer):
+    writer.write(dtype, 3)
+
+
+def pack_len(length, writer, short=False):
     assert(length >= 0)
     if short:
-        sz = 3
-        return BitStream(uint=length, length=sz)
+        writer.write(length, 3)
+    elif writer.varints:
+        pack_varint(length, writer)
     elif length < 2**8-1:
-        return BitStream(uint=0, length=2) + BitStream(uint=length, length=8)
+        writer.write(length, 10)
     elif length < 2**16-1:
-        return BitStream(uint=1, length=2) + BitStream(uint=length, length=16)
+        writer.write((1 << 16) | length, 18)
     elif length < 2**32-1:
-        return BitStream(uint=2, length=2) + BitStream(uint=length, length=32)
+        writer.write((2 << 32) | length, 34)
     elif length < 2**64-1:
-        return BitStream(uint=3, length=2) + BitStream(uint=length, length=64)
+        writer.write((3 << 64) | length, 66)
+
+
+def varint_bits(value):
+    """ Returns the LEB128 groups of an unsigned int as an int, along with
+    their width: 7 bits of the value per byte, least significant first, with
+    the top bit of every byte but the last set """
+    bits = width = 0
+    while value >= 0x80:
+        bits = (bits << 8) | 0x80 | (value & 0x7f)
+        value >>= 7
+        width += 8
+    return (bits << 8) | value, width + 8
+
+
+def pack_varint(value, writer):
+    bits, width = varint_bits(value)
+    writer.write(bits, width)
+
+
+def pack_bool(boolean, writer):
+    writer.write(1 if boolean else 0, 1)
 
 
+def numeric_codec(floats, varints=False):
+    """ Returns the primitive encoders of a numeric codec """
+    if floats not in numeric_codecs:
+        raise ValueError("Unknown numeric codec. Got:", floats)
+    return (varint_codecs if varints else numeric_codecs)[floats]
 
-def pack_bool(boolean):
-    return BitStream(uint=1, length=1) if boolean else BitStream(uint=0, length=1)
 
+def message_flags(key_table=False, packed_arrays=False, varints=False, string_table=False,
+                  chunked_lists=False):
+    """ Returns the FLAG_* extensions needed by the given encoding options """
+    flags = 0
+    if key_table:
+        flags |= FLAG_KEY_TABLE
+    if packed_arrays or chunked_lists:
+        flags |= FLAG_EXTENDED_TYPES
+    if varints:
+        flags |= FLAG_VARINTS
+    if string_table:
+        flags |= FLAG_STRING_TABLE
+    return flags
 
-def encode(data):
-    bytelist = []
-    encode_object(data, bytelist)
-    msg = pack_message(bytelist)
+
+def encode(data, key_table=False, packed_arrays=False, workers=None,
+           floats=FLOATS_SHORTEST, varints=False, string_table=False,
+           string_table_size=STRING_TABLE_SIZE, chunked_lists=False, compression=None):
+    """ Encodes data into a ProtoN message
+    @param data - the object to encode
+    @param {bool} key_table - send each key in full only the first time it
+        is seen and as a back-reference after that (version 2 extension)
+    @param {bool} packed_arrays - send homogeneous int or float sequences,
+        array.array and NumPy arrays as packed arrays (version 2 extension)
+    @param workers - if given, the number of processes (or an Executor) to
+        split the children of a top-level list or object across
+    @param {str} floats - the numeric codec: FLOATS_SHORTEST sends short
+        floats as ShortStr, FLOATS_FLOAT64 sends every float as a float64
+    @param {bool} varints - send ints as zigzag varints and lengths as
+        varints, which is smaller for small values (version 2 extension)
+    @param {bool} string_table - send a string value which is among the
+        most recently sent as a back-reference (version 2 extension)
+    @param {int} string_table_size - the number of recent strings kept
+    @param {bool} chunked_lists - send iterators, such as generators, and
+        other iterables which are not sequences, such as dict.values(), as
+        chunked lists of unknown length instead of collecting them into
+        lists first (version 2 extension)
+    @param {Compression} compression - if given, how to compress messages
+        which reach its threshold (version 2 extension)
+    """
+    if workers and (key_table or string_table):
+        raise ValueError("Parallel encoding does not support the key or string tables")
+    if workers and chunked_lists:
+        # Iterators cannot be sent to the worker processes
+        raise ValueError("Parallel encoding does not support chunked lists")
+    writer = BitWriter()
+    pack_header(writer, message_flags(key_table, packed_arrays, varints, string_table,
+                                      chunked_lists), string_table_size)
+    writer.packed_arrays = packed_arrays
+    writer.chunked_lists = chunked_lists
+    writer.encoders = numeric_codec(floats, varints)
+    if workers:
+        encode_parallel(data, writer, workers)
+    else:
+        encode_object(data, writer)
+    msg = pack_message(writer)
+    if compression is not None:
+        msg = compression.compress_message(msg)
     return msg
+
+
+def encode_to(data, writable, buffer_size=BUFFER_SIZE, key_table=False,
+              packed_arrays=False, floats=FLOATS_SHORTEST, varints=False,
+              string_table=False, string_table_size=STRING_TABLE_SIZE, chunked_lists=False,
+              compression=None):
+    """ Encodes data as encode() does, but writes the message to `writable`
+    in pieces of about `buffer_size` bytes instead of returning it, so the
+    whole message is never held in memory. Returns the number of bytes
+    written.
+    @param writable - object with a `write` method accepting bytes
+    @param {int} buffer_size - number of bytes to collect before writing
+    @param {bool} key_table - send repeated keys as back-references
+    @param {bool} packed_arrays - send numeric sequences as packed arrays
+    @param {str} floats - the numeric codec, as in encode()
+    @param {bool} varints - send ints and lengths as varints
+    @param {bool} string_table - send recent string values as back-references
+    @param {int} string_table_size - the number of recent strings kept
+    @param {bool} chunked_lists - send iterators as chunked lists, so
+        generators and cursors are streamed without being collected
+    @param {Compression} compression - compress the message as it is written
+        once it reaches the threshold
+    """
+    if compression is not None:
+        writable = compression.stream(writable)
+    writer = StreamWriter(writable, buffer_size)
+    pack_header(writer, message_flags(key_table, packed_arrays, varints, string_table,
+                                      chunked_lists), string_table_size)
+    writer.packed_arrays = packed_arrays
+    writer.chunked_lists = chunked_lists
+    writer.encoders = numeric_codec(floats, varints)
+    encode_object(data, writer)
+    written = writer.close()
+    if compression is not None:
+        return writable.close()
+    return written
+
+
+def encode_many(iterable, key_table=False, packed_arrays=False, floats=FLOATS_SHORTEST,
+                varints=False, string_table=False, string_table_size=STRING_TABLE_SIZE,
+                chunked_lists=False, compression=None):
+    """ Encodes every object of an iterable as its own message, and returns
+    the messages as one batch in which each is preceded by its length in
+    bytes. The whole batch is written through a single buffer.
+    @param iterable - the objects to encode
+    @param {bool} key_table - send repeated keys as back-references
+    @param {bool} packed_arrays - send numeric sequences as packed arrays
+    @param {str} floats - the numeric codec, as in encode()
+    @param {bool} varints - send ints and lengths as varints
+    @param {bool} string_table - send recent string values as back-references
+    @param {int} string_table_size - the number of recent strings kept
+    @param {bool} chunked_lists - send iterators as chunked lists
+    @param {Compression} compression - compress each message which reaches
+        the threshold
+    """
+    writer = BitWriter()
+    writer.encoders = numeric_codec(floats, varints)
+    writer.chunked_lists = chunked_lists
+    buffer = writer.buffer
+    flags = message_flags(key_table, packed_arrays, varints, string_table, chunked_lists)
+    memo = set()
+    for data in iterable:
+        # Reserve the length, which is filled in once the message is written
+        start = len(buffer)
+        buffer += bytes(FRAME_LENGTH_BYTES)
+        pack_header(writer, flags, string_table_size)
+        writer.packed_arrays = packed_arrays
+        encode_object(data, writer, memo)
+        writer.align()
+        if compression is not None:
+            body = start + FRAME_LENGTH_BYTES
+            buffer[body:] = compression.compress_message(bytes(buffer[body:]))
+        length = len(buffer) - start - FRAME_LENGTH_BYTES
+        if length >= 2**(8*FRAME_LENGTH_BYTES):
+            raise ValueError("Message too long for a batch. Got:", length)
+        buffer[start:start + FRAME_LENGTH_BYTES] = length.to_bytes(FRAME_LENGTH_BYTES, 'big')
+    return bytes(buffer)
+
+
+class Encoder(object):
+    """ Encoder for servers which encode many messages, such as one kept per
+    thread or worker. It reuses its bit writer and circular-reference memo
+    between messages, and keeps the pair header and bytes of every key it
+    has seen pre-encoded, so a key is only encoded the first time. Output is
+    identical to encode(). An Encoder must not be shared between threads.
+    @param {bool} key_table - send repeated keys as back-references
+    @param {bool} packed_arrays - send numeric sequences as packed arrays
+    @param {str} floats - the numeric codec, as in encode()
+    @param {bool} varints - send ints and lengths as varints
+    @param {bool} string_table - send recent string values as back-references
+    @param {int} string_table_size - the number of recent strings kept
+    @param {bool} chunked_lists - send iterators as chunked lists
+    @param {Compression} compression - compress each message which reaches
+        the threshold
+    """
+
+    def __init__(self, key_table=False, packed_arrays=False, floats=FLOATS_SHORTEST,
+                 varints=False, string_table=False, string_table_size=STRING_TABLE_SIZE,
+                 chunked_lists=False, compression=None):
+        self.flags = message_flags(key_table, packed_arrays, varints, string_table,
+                                   chunked_lists)
+        self.string_table_size = string_table_size
+        self.packed_arrays = packed_arrays
+        self.compression = compression
+        self.writer = BitWriter()
+        self.writer.chunked_lists = chunked_lists
+        self.writer.key_cache = {}
+        self.writer.encoders = numeric_codec(floats, varints)
+        self.memo = set()
+
+    def start(self, buffer):
+        """ Sets the writer up for a new message appended to `buffer` """
+        writer = self.writer
+        writer.buffer = buffer
+        writer.acc = writer.nbits = 0
+        self.memo.clear()
+        pack_header(writer, self.flags, self.string_table_size)
+        writer.packed_arrays = self.packed_arrays
+        return writer
+
+    def encode(self, data):
+        """ Encodes data into a ProtoN message """
+        buffer = self.writer.buffer
+        del buffer[:]
+        writer = self.start(buffer)
+        encode_object(data, writer, self.memo)
+        if self.compression is not None:
+            return self.compression.compress_message(writer.getvalue())
+        return writer.getvalue()
+
+    def encode_into(self, data, buffer):
+        """ Appends a ProtoN message to a caller-supplied bytearray, padded to
+        a whole byte, and returns the length of the message in bits before
+        padding, which for a compressed message is a whole number of bytes
+        @param data - the object to encode
+        @param {bytearray} buffer - the buffer to append the message to
+        """
+        own = self.writer.buffer
+        start = len(buffer) << 3
+        try:
+            writer = self.start(buffer)
+            encode_object(data, writer, self.memo)
+            nbits = writer.bit_length() - start
+            writer.align()
+            if self.compression is not None:
+                body = start >> 3
+                message = self.compression.compress_message(bytes(buffer[body:]))
+                if len(message) < len(buffer) - body:
+                    buffer[body:] = message
+                    nbits = len(message) << 3
+        finally:
+            self.writer.buffer = own
+        return nbits
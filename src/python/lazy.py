@@ -0,0 +1,169 @@
+#! /usr/env python
+
+from constants import *
+from collections.abc import Mapping, Sequence
+from decoder import BitReader, open_message, decode_object, skip_object, \
+    flag_unpackers, UNPACKER_FLAGS, unpack_extension, unpack_len, unpack_string
+
+
+def decode_lazy(payload, dictionary=None, max_size=None):
+    """ Decodes a payload on demand. Primitives are returned as usual, but
+    lists and objects are returned as LazyList and LazyObject proxies which
+    only decode a child once it is accessed, skipping over unrelated subtrees.
+    A compressed message is decompressed in full first.
+    @param {bytes} payload - the ProtoN message to decode
+    @param {bytes} dictionary - the preset dictionary of compressed messages
+    @param {int} max_size - longest message a compressed message may hold,
+        as in decode()
+    """
+    reader = open_message(BitReader(payload), dictionary, max_size)
+    flags = reader.flags
+    if flags & (FLAG_KEY_TABLE | FLAG_STRING_TABLE):
+        # Back-references can only be resolved by reading the message in order
+        raise ValueError("Lazy decoding does not support the key or string tables")
+    return lazy_object(reader.payload, reader.pos, flags)
+
+
+def open_reader(payload, pos, flags):
+    """ Returns a reader at bit `pos` of the payload, set up for the
+    extensions listed in the message's flags """
+    reader = BitReader(payload)
+    reader.pos = pos
+    reader.flags = flags
+    return reader
+
+
+def lazy_object(payload, pos, flags):
+    """ Returns the value whose dtype starts at bit `pos` of the payload,
+    wrapping containers in proxies without reading any of their entries """
+    reader = open_reader(payload, pos, flags)
+    dtype = reader.read(3)
+    unpackers = flag_unpackers[flags & UNPACKER_FLAGS]
+    if dtype in unpackers:
+        return unpackers[dtype](reader)
+    elif dtype == TYPE_LIST:
+        length = unpack_len(reader)
+        return LazyList(payload, pos, reader.pos, length, flags)
+    elif dtype == TYPE_OBJECT:
+        length = unpack_len(reader)
+        return LazyObject(payload, pos, reader.pos, length, flags)
+    elif dtype == TYPE_EXTENSION and flags & FLAG_EXTENDED_TYPES:
+        return unpack_extension(reader)
+    else:
+        raise ValueError("Expected a primitive or container dtype. Got:", dtype)
+
+
+class LazyContainer(object):
+    """ Common state of the lazy proxies
+    @param {bytes} payload - the message the container is part of
+    @param {int} start - bit offset of the container's dtype
+    @param {int} length - number of entries in the container
+    @param {int} flags - the extensions used by the message
+    """
+
+    def __init__(self, payload, start, length, flags):
+        self.payload = payload
+        self.start = start
+        self.length = length
+        self.flags = flags
+        # Decoded children, kept so repeated access returns the same value
+        self.values = {}
+
+    def __len__(self):
+        return self.length
+
+    def decode(self):
+        """ Fully decodes the container into plain lists and dicts """
+        return decode_object(open_reader(self.payload, self.start, self.flags))
+
+
+class LazyList(LazyContainer, Sequence):
+    """ Read-only list proxy over an encoded ProtoN list. The bit offset of
+    each element is recorded the first time the list is scanned that far, so
+    later accesses jump straight to the element. """
+
+    def __init__(self, payload, start, pos, length, flags):
+        LazyContainer.__init__(self, payload, start, length, flags)
+        # Bit offsets of the elements scanned so far
+        self.offsets = [pos]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("LazyList index out of range")
+        if index not in self.values:
+            self.scan(index)
+            self.values[index] = lazy_object(self.payload, self.offsets[index], self.flags)
+        return self.values[index]
+
+    def scan(self, index):
+        """ Extends the offset index up to the element at `index` """
+        offsets = self.offsets
+        if index < len(offsets):
+            return
+        reader = open_reader(self.payload, offsets[-1], self.flags)
+        while index >= len(offsets):
+            skip_object(reader)
+            offsets.append(reader.pos)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, (str, bytes)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "LazyList(" + str(self.length) + " elements)"
+
+
+class LazyObject(LazyContainer, Mapping):
+    """ Read-only mapping proxy over an encoded ProtoN object. Keys are read
+    and their value offsets recorded as the object is scanned, stopping as
+    soon as a requested key is found; values are skipped, not decoded. """
+
+    def __init__(self, payload, start, pos, length, flags):
+        LazyContainer.__init__(self, payload, start, length, flags)
+        # Bit offset of the value of each key scanned so far
+        self.index = {}
+        self.scan_pos = pos
+        self.scanned = 0
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            if key not in self.index:
+                self.scan(key)
+                if key not in self.index:
+                    raise KeyError(key)
+            self.values[key] = lazy_object(self.payload, self.index[key], self.flags)
+        return self.values[key]
+
+    def __contains__(self, key):
+        if key not in self.index:
+            self.scan(key)
+        return key in self.index
+
+    def __iter__(self):
+        self.scan()
+        return iter(self.index)
+
+    def scan(self, key=None):
+        """ Indexes further entries until `key` is found, or to the end """
+        reader = open_reader(self.payload, self.scan_pos, self.flags)
+        index = self.index
+        found = False
+        while self.scanned < self.length and not found:
+            if reader.read(3) != TYPE_PAIR:
+                raise ValueError("Expected a pair dtype in object")
+            entry = unpack_string(reader)
+            index[entry] = reader.pos
+            skip_object(reader)
+            self.scanned += 1
+            found = entry == key
+        self.scan_pos = reader.pos
+
+    def __repr__(self):
+        return "LazyObject(" + str(self.length) + " entries)"
@@ -0,0 +1,318 @@
+#! /usr/env python
+
+from io import BytesIO
+from json import dumps, loads
+from hashlib import blake2b
+from threading import Lock
+from collections import OrderedDict
+from encoder import encode
+from decoder import LimitExceeded, decode
+from validator import MAX_SIZE
+
+# Content type sent with ProtoN responses, as used by the echo server
+MIMETYPE = 'proton'
+# Content types accepted for ProtoN request bodies
+MIMETYPES = (MIMETYPE, 'application/proton')
+JSON_MIMETYPE = 'application/json'
+# Total size in bytes of the encoded responses kept by default
+CACHE_SIZE = 2**24
+# Statuses of responses which have no body
+BODILESS_STATUSES = (204, 205, 304)
+
+
+class ResponseCache(object):
+    """ LRU cache of encoded responses, bounded by their total size. It is
+    safe to share between threads and between middleware instances.
+    @param {int} max_size - total bytes of encoded responses to keep
+    """
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        """ Returns the encoded response stored for a key, or None """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """ Stores an encoded response, evicting the least recently used
+        responses until the cache is within its size """
+        if len(value) > self.max_size:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+def media_type(value):
+    """ Returns the media type of a Content-Type header, without parameters """
+    return value.split(';', 1)[0].strip().lower()
+
+
+def accepts_proton(accept):
+    """ Returns whether an Accept header prefers ProtoN to JSON. Wildcards
+    are left to JSON, so only clients which name ProtoN receive it. """
+    proton = json = 0.0
+    for media_range in (accept or '').split(','):
+        params = media_range.split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media = params[0].strip().lower()
+        if media in MIMETYPES:
+            proton = max(proton, quality)
+        elif media == JSON_MIMETYPE:
+            json = max(json, quality)
+    return proton > 0 and proton >= json
+
+
+def proton_to_json(body, max_size):
+    """ Translates a ProtoN request body into JSON for the wrapped app
+    @param {int} max_size - longest body, and longest message a compressed
+        body may hold, in bytes
+    """
+    if len(body) > max_size:
+        raise LimitExceeded("Request body longer than the limit. Got:", len(body))
+    return dumps(decode(body, max_size=max_size), separators=(',', ':')).encode('utf-8')
+
+
+def request_error(error):
+    """ Returns the status code, reason and body of the response to a ProtoN
+    request body which could not be translated """
+    if isinstance(error, LimitExceeded):
+        return 413, 'Payload Too Large', b'ProtoN request body is too large'
+    return 400, 'Bad Request', b'Invalid ProtoN request body'
+
+
+def translates(method, status, content_type):
+    """ Returns whether a response is held back to be translated into ProtoN,
+    which only a successful JSON response with a body can be. Any other
+    response is passed on as soon as it starts. """
+    return (media_type(content_type) == JSON_MIMETYPE and 200 <= status < 300
+            and status not in BODILESS_STATUSES and method != 'HEAD')
+
+
+def options_key(options):
+    """ Returns the part of a cache key which tells encode() options apart """
+    return tuple(sorted(options.items()))
+
+
+def json_to_proton(body, etag, resource, cache, options):
+    """ Translates a JSON response body into ProtoN, reusing the cached
+    encoding for the same resource and ETag or, without one, the same body.
+    ETags are only unique within one resource, so the key also holds the
+    request method, path and query, and the encode() options.
+    @param {tuple} resource - the request's method, path and query string
+    """
+    if etag:
+        key = resource + ('etag', etag, options_key(options))
+    else:
+        key = resource + ('hash', blake2b(body, digest_size=16).digest(),
+                          options_key(options))
+    value = cache.get(key)
+    if value is None:
+        value = encode(loads(body), **options)
+        cache.put(key, value)
+    return value
+
+
+class ProtoNMiddleware(object):
+    """ WSGI middleware which lets a JSON app speak ProtoN. Request bodies
+    sent as ProtoN are handed to the app as JSON, and JSON responses are
+    encoded as ProtoN for clients whose Accept header prefers it. Any other
+    response, such as one to a HEAD request, passes through unbuffered. With
+    Flask:
+    `app.wsgi_app = ProtoNMiddleware(app.wsgi_app)`
+    @param app - the WSGI app to wrap
+    @param {ResponseCache} cache - cache of encoded responses, by default
+        a new one of CACHE_SIZE bytes
+    @param {int} max_size - longest ProtoN request body, and longest message
+        a compressed one may hold, in bytes; a larger one is answered 413
+    @param options - passed on to encode(), such as key_table=True
+    """
+
+    def __init__(self, app, cache=None, max_size=MAX_SIZE, **options):
+        self.app = app
+        self.cache = ResponseCache() if cache is None else cache
+        self.max_size = max_size
+        self.options = options
+
+    def __call__(self, environ, start_response):
+        if media_type(environ.get('CONTENT_TYPE', '')) in MIMETYPES:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            try:
+                if length > self.max_size:
+                    raise LimitExceeded("Request body longer than the limit. Got:", length)
+                body = proton_to_json(environ['wsgi.input'].read(length), self.max_size)
+            except ValueError as error:
+                code, reason, message = request_error(error)
+                start_response(str(code) + ' ' + reason, [('Content-Type', 'text/plain')])
+                return [message]
+            environ['wsgi.input'] = BytesIO(body)
+            environ['CONTENT_TYPE'] = JSON_MIMETYPE
+            environ['CONTENT_LENGTH'] = str(len(body))
+        if not accepts_proton(environ.get('HTTP_ACCEPT')):
+            return self.app(environ, start_response)
+
+        method = environ.get('REQUEST_METHOD')
+        # [status, headers, exc_info] of a response held back to translate,
+        # or True once a response has passed through
+        response = []
+        chunks = []
+        def capture(status, headers, exc_info=None):
+            fields = dict((name.lower(), value) for name, value in headers)
+            if translates(method, int(status[:3]), fields.get('content-type', '')):
+                response[:] = [status, headers, exc_info]
+                return chunks.append
+            response[:] = [True]
+            headers = list(headers) + [('Vary', 'Accept')]
+            if exc_info:
+                return start_response(status, headers, exc_info)
+            return start_response(status, headers)
+        result = self.app(environ, capture)
+        if response == [True]:
+            return result
+        resource = (method, environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                    environ.get('QUERY_STRING', ''))
+        return self.translated(result, response, chunks, resource, start_response)
+
+    def translated(self, result, response, chunks, resource, start_response):
+        """ Yields the app's response, translated if it was held back. An app
+        may only start its response once its result is iterated, so whether
+        it is held back may only be known then. """
+        try:
+            for chunk in result:
+                if response == [True]:
+                    yield chunk
+                else:
+                    chunks.append(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if response == [True]:
+            return
+        status, headers, exc_info = response
+        body = b''.join(chunks)
+        if body:
+            fields = dict((name.lower(), value) for name, value in headers)
+            body = json_to_proton(body, fields.get('etag'), resource, self.cache, self.options)
+            headers = [(name, value) for name, value in headers
+                       if name.lower() not in ('content-type', 'content-length')]
+            headers += [('Content-Type', MIMETYPE), ('Content-Length', str(len(body)))]
+        headers = list(headers) + [('Vary', 'Accept')]
+        if exc_info:
+            start_response(status, headers, exc_info)
+        else:
+            start_response(status, headers)
+        yield body
+
+
+class ProtoNASGIMiddleware(object):
+    """ ASGI middleware which lets a JSON app, such as a Starlette app, speak
+    ProtoN in the same way as ProtoNMiddleware does for WSGI
+    @param app - the ASGI app to wrap
+    @param {ResponseCache} cache - cache of encoded responses, by default
+        a new one of CACHE_SIZE bytes
+    @param {int} max_size - longest ProtoN request body, and longest message
+        a compressed one may hold, in bytes; a larger one is answered 413
+    @param options - passed on to encode(), such as key_table=True
+    """
+
+    def __init__(self, app, cache=None, max_size=MAX_SIZE, **options):
+        self.app = app
+        self.cache = ResponseCache() if cache is None else cache
+        self.max_size = max_size
+        self.options = options
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        fields = dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                      for name, value in scope['headers'])
+        if media_type(fields.get('content-type', '')) in MIMETYPES:
+            chunks = []
+            size = 0
+            more = True
+            try:
+                while more:
+                    message = await receive()
+                    chunks.append(message.get('body', b''))
+                    size += len(chunks[-1])
+                    if size > self.max_size:
+                        raise LimitExceeded("Request body longer than the limit")
+                    more = message.get('more_body', False)
+                body = proton_to_json(b''.join(chunks), self.max_size)
+            except ValueError as error:
+                code, reason, message = request_error(error)
+                await send({'type': 'http.response.start', 'status': code,
+                            'headers': [(b'content-type', b'text/plain')]})
+                await send({'type': 'http.response.body', 'body': message})
+                return
+            scope = dict(scope)
+            scope['headers'] = [(name, value) for name, value in scope['headers']
+                                if name.lower() not in (b'content-type', b'content-length')]
+            scope['headers'] += [(b'content-type', JSON_MIMETYPE.encode('latin-1')),
+                                 (b'content-length', str(len(body)).encode('latin-1'))]
+            # The app receives the translated body once, and then whatever the
+            # server sends next, such as http.disconnect
+            request = [{'type': 'http.request', 'body': body, 'more_body': False}]
+            upstream = receive
+            async def receive():
+                if request:
+                    return request.pop()
+                return await upstream()
+        if not accepts_proton(fields.get('accept')):
+            return await self.app(scope, receive, send)
+
+        # The http.response.start of a response held back to translate
+        start = {}
+        chunks = []
+        async def capture(message):
+            if message['type'] == 'http.response.start':
+                names = dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                             for name, value in message.get('headers', []))
+                if translates(scope.get('method'), message['status'],
+                              names.get('content-type', '')):
+                    start.update(message)
+                    return
+                headers = list(message.get('headers', [])) + [(b'vary', b'Accept')]
+                return await send(dict(message, headers=headers))
+            if message['type'] != 'http.response.body' or not start:
+                return await send(message)
+            chunks.append(message.get('body', b''))
+            if message.get('more_body', False):
+                return
+            body = b''.join(chunks)
+            headers = list(start.get('headers', []))
+            if body:
+                names = dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                             for name, value in headers)
+                resource = (scope.get('method'), scope.get('root_path', '') + scope.get('path', ''),
+                            scope.get('query_string', b''))
+                body = json_to_proton(body, names.get('etag'), resource, self.cache,
+                                      self.options)
+                headers = [(name, value) for name, value in headers
+                           if name.lower() not in (b'content-type', b'content-length')]
+                headers += [(b'content-type', MIMETYPE.encode('latin-1')),
+                            (b'content-length', str(len(body)).encode('latin-1'))]
+            headers.append((b'vary', b'Accept'))
+            await send(dict(start, headers=headers))
+            await send({'type': 'http.response.body', 'body': body})
+        await self.app(scope, receive, capture)
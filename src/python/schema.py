@@ -0,0 +1,273 @@
+#! /usr/env python
+
+from constants import *
+from collections.abc import Mapping
+from encoder import BitWriter, encode, encode_object, pack_header, pack_message, \
+    pack_type, pack_len, pair_key_bits, variable_encoders
+from decoder import BitReader, TruncatedPayload, decode, decode_header, \
+    decode_object, unpack_len, primitive_unpackers
+
+# Shapes are tuples naming a kind, followed by what the kind holds:
+# ('object', ((key, shape), ...)), ('list', item shape), ('nullable', shape),
+# a primitive such as ('int',), or ('any',) for values of no fixed shape
+ANY = ('any',)
+# Python type and dtype of each primitive shape
+primitive_shapes = {
+    'null': (type(None), TYPE_NULL),
+    'bool': (bool, TYPE_BOOL),
+    'int': (int, TYPE_INT),
+    'float': (float, TYPE_FLOAT),
+    'string': (str, TYPE_STRING),
+}
+# Primitive shape of each JSON Schema type
+json_schema_types = {
+    'null': 'null', 'boolean': 'bool', 'integer': 'int',
+    'number': 'float', 'string': 'string',
+}
+
+
+class SchemaMismatch(ValueError):
+    """ Raised when a value does not have the shape a schema expects """
+
+
+def infer_shape(obj):
+    """ Returns the shape of a sample object. The elements of a list are
+    merged into one shape, which is ANY if they differ. """
+    if obj is None:
+        return ('null',)
+    for kind, (cls, dtype) in primitive_shapes.items():
+        if type(obj) is cls:
+            return (kind,)
+    if isinstance(obj, Mapping) and all(isinstance(key, str) for key in obj):
+        return ('object', tuple((key, infer_shape(value)) for key, value in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        item = None
+        for value in obj:
+            item = merge_shapes(item, infer_shape(value))
+        return ('list', ANY if item is None else item)
+    return ANY
+
+
+def merge_shapes(a, b):
+    """ Returns a shape which both shapes fit: the shape itself if they are
+    equal, a nullable shape if one of them is null, and ANY otherwise """
+    if a is None or a == b:
+        return b
+    if a == ('null',):
+        a, b = b, a
+    if b == ('null',):
+        return a if a[0] == 'nullable' else ('nullable', a)
+    if a[0] == 'nullable' or b[0] == 'nullable':
+        inner = merge_shapes(a[1] if a[0] == 'nullable' else a,
+                             b[1] if b[0] == 'nullable' else b)
+        return ANY if inner is ANY else ('nullable', inner)
+    if a[0] == b[0] == 'list':
+        return ('list', merge_shapes(a[1], b[1]))
+    if (a[0] == b[0] == 'object'
+            and [key for key, _ in a[1]] == [key for key, _ in b[1]]):
+        return ('object', tuple((key, merge_shapes(shape, other))
+                                for (key, shape), (_, other) in zip(a[1], b[1])))
+    return ANY
+
+
+def json_schema_shape(schema):
+    """ Returns the shape described by a subset of JSON Schema: the types
+    null, boolean, integer, number, string, array with a single `items`
+    schema and object with `properties`, whose keys are expected in order.
+    A type list of one type and "null" is nullable. Anything else is ANY. """
+    kind = schema.get('type')
+    if isinstance(kind, list):
+        kinds = [k for k in kind if k != 'null']
+        if len(kinds) != 1:
+            return ANY
+        inner = json_schema_shape(dict(schema, type=kinds[0]))
+        if len(kind) == 1 or inner is ANY:
+            return inner
+        return ('nullable', inner)
+    if kind in json_schema_types:
+        return (json_schema_types[kind],)
+    if kind == 'array' and isinstance(schema.get('items'), dict):
+        return ('list', json_schema_shape(schema['items']))
+    if kind == 'object' and 'properties' in schema:
+        return ('object', tuple((key, json_schema_shape(value))
+                                for key, value in schema['properties'].items()))
+    return ANY
+
+
+def header_bits(dtype, length):
+    """ Returns the bits of a container's dtype and length as an int, along
+    with their width """
+    writer = BitWriter()
+    pack_type(dtype, writer)
+    pack_len(length, writer)
+    width = writer.bit_length()
+    return int.from_bytes(writer.getvalue(), 'big') >> (-width & 7), width
+
+
+def compile_encoder(shape):
+    """ Returns a function writing a value of the given shape, as
+    encode_object would, without inferring the type of each value. Only the
+    exact type of each primitive is compared, and each key of an object in
+    turn, raising SchemaMismatch as soon as the value differs from the shape.
+    """
+    kind = shape[0]
+    if kind == 'any':
+        return encode_object
+    elif kind == 'null':
+        def encode_null(value, writer):
+            if value is not None:
+                raise SchemaMismatch("Expected null")
+            writer.write(TYPE_NULL, 3)
+        return encode_null
+    elif kind in primitive_shapes:
+        cls = primitive_shapes[kind][0]
+        encode_variable = variable_encoders[cls]
+        def encode_primitive(value, writer):
+            if value.__class__ is not cls:
+                raise SchemaMismatch("Expected:", cls)
+            encode_variable(value, writer)
+        return encode_primitive
+    elif kind == 'nullable':
+        encode_inner = compile_encoder(shape[1])
+        def encode_nullable(value, writer):
+            if value is None:
+                writer.write(TYPE_NULL, 3)
+            else:
+                encode_inner(value, writer)
+        return encode_nullable
+    elif kind == 'list':
+        encode_item = compile_encoder(shape[1])
+        def encode_list(value, writer):
+            if value.__class__ is not list and value.__class__ is not tuple:
+                raise SchemaMismatch("Expected a list")
+            length = len(value)
+            if length < 2**8-1:
+                writer.write((TYPE_LIST << 10) | length, 13)
+            else:
+                pack_type(TYPE_LIST, writer)
+                pack_len(length, writer)
+            for item in value:
+                encode_item(item, writer)
+        return encode_list
+    elif kind == 'object':
+        count = len(shape[1])
+        header, width = header_bits(TYPE_OBJECT, count)
+        fields = [(key, pair_key_bits(key), compile_encoder(field))
+                  for key, field in shape[1]]
+        def encode_fields(value, writer):
+            if value.__class__ is not dict or len(value) != count:
+                raise SchemaMismatch("Expected an object with keys:", [f[0] for f in fields])
+            write = writer.write
+            write(header, width)
+            for (key, item), (expected, (bits, bits_width), encode_item) in zip(value.items(), fields):
+                if key != expected:
+                    raise SchemaMismatch("Expected key:", expected)
+                write(bits, bits_width)
+                encode_item(item, writer)
+        return encode_fields
+    raise ValueError("Unknown shape. Got:", shape)
+
+
+def compile_decoder(shape):
+    """ Returns a function reading a value of the given shape once its dtype
+    has been read, raising SchemaMismatch if the message differs from the
+    shape. Each key of an object is compared with a single read of its
+    pair header and bytes rather than decoded. """
+    kind = shape[0]
+    if kind == 'any':
+        def decode_any(reader, dtype):
+            reader.pos -= 3
+            return decode_object(reader)
+        return decode_any
+    elif kind in primitive_shapes:
+        expected = primitive_shapes[kind][1]
+        unpack = primitive_unpackers[expected]
+        def decode_primitive(reader, dtype):
+            if dtype != expected:
+                raise SchemaMismatch("Expected dtype:", expected)
+            return unpack(reader)
+        return decode_primitive
+    elif kind == 'nullable':
+        decode_inner = compile_decoder(shape[1])
+        def decode_nullable(reader, dtype):
+            if dtype == TYPE_NULL:
+                return None
+            return decode_inner(reader, dtype)
+        return decode_nullable
+    elif kind == 'list':
+        decode_item = compile_decoder(shape[1])
+        def decode_list(reader, dtype):
+            if dtype != TYPE_LIST:
+                raise SchemaMismatch("Expected a list")
+            read = reader.read
+            return [decode_item(reader, read(3)) for _ in range(unpack_len(reader))]
+        return decode_list
+    elif kind == 'object':
+        count = len(shape[1])
+        fields = [(key, pair_key_bits(key), compile_decoder(field))
+                  for key, field in shape[1]]
+        def decode_fields(reader, dtype):
+            if dtype != TYPE_OBJECT or unpack_len(reader) != count:
+                raise SchemaMismatch("Expected an object with keys:", [f[0] for f in fields])
+            read = reader.read
+            obj = {}
+            for key, (bits, width), decode_item in fields:
+                if read(width) != bits:
+                    raise SchemaMismatch("Expected key:", key)
+                obj[key] = decode_item(reader, read(3))
+            return obj
+        return decode_fields
+    raise ValueError("Unknown shape. Got:", shape)
+
+
+class Schema(object):
+    """ A message shape compiled into an encoder and decoder specialized for
+    it. Both produce and read the usual wire format, so messages encoded
+    with a schema decode with decode() and vice versa. Values which do not
+    fit the shape are encoded and decoded generically instead.
+    @param shape - the shape of the messages, as built by infer_shape or
+        json_schema_shape
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.encoder = compile_encoder(shape)
+        self.decoder = compile_decoder(shape)
+        # Number of messages which did not fit the shape
+        self.fallbacks = 0
+
+    @classmethod
+    def from_sample(cls, *samples):
+        """ Compiles the shape which every sample fits """
+        shape = None
+        for sample in samples:
+            shape = merge_shapes(shape, infer_shape(sample))
+        return cls(ANY if shape is None else shape)
+
+    @classmethod
+    def from_json_schema(cls, schema):
+        """ Compiles the shape described by a JSON Schema dict """
+        return cls(json_schema_shape(schema))
+
+    def encode(self, data):
+        """ Encodes data into a ProtoN message, identical to encode(data) """
+        writer = BitWriter()
+        pack_header(writer)
+        try:
+            self.encoder(data, writer)
+        except SchemaMismatch:
+            self.fallbacks += 1
+            return encode(data)
+        return pack_message(writer)
+
+    def decode(self, payload):
+        """ Decodes a ProtoN message, as decode(payload) would """
+        reader = BitReader(payload)
+        if decode_header(reader):
+            # Extensions are left to the generic decoder
+            return decode(payload)
+        try:
+            return self.decoder(reader, reader.read(3))
+        except (SchemaMismatch, TruncatedPayload):
+            self.fallbacks += 1
+            return decode(payload)
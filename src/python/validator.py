@@ -0,0 +1,165 @@
+#! /usr/env python
+
+from constants import *
+from decoder import BitReader, TruncatedPayload, LimitExceeded, open_message, \
+    unpack_len, unpack_varint, packed_sizes
+
+# Default limits of validate()
+MAX_DEPTH = 2**10
+MAX_STRING_LENGTH = 2**24
+MAX_ELEMENTS = 2**24
+MAX_SIZE = 2**26
+
+
+class Limits(object):
+    """ Bounds a message must stay within to pass validate()
+    @param {int} max_depth - most containers nested within each other
+    @param {int} max_string_length - longest string or key, in bytes
+    @param {int} max_elements - most values in the whole message, counting
+        every element of a packed array
+    @param {int} max_size - longest message a compressed message may hold,
+        in bytes
+    """
+
+    def __init__(self, max_depth=MAX_DEPTH, max_string_length=MAX_STRING_LENGTH,
+                 max_elements=MAX_ELEMENTS, max_size=MAX_SIZE):
+        self.max_depth = max_depth
+        self.max_string_length = max_string_length
+        self.max_elements = max_elements
+        self.max_size = max_size
+
+
+def skip_string(reader, limits):
+    """ Advances the reader past a string's len and bytes, checking its
+    length before anything is skipped """
+    length = unpack_len(reader)
+    if length > limits.max_string_length:
+        raise LimitExceeded("String longer than the limit. Got:", length)
+    reader.skip(length << 3)
+
+
+def check_entries(reader, length, values, limits):
+    """ Checks the number of entries a container claims, before any of them
+    are read, against the value limit and the bits left in the payload, of
+    which each entry takes at least three """
+    if values + length > limits.max_elements:
+        raise LimitExceeded("More values than the limit. Got:", values + length)
+    if length * 3 > reader.end - reader.pos:
+        raise TruncatedPayload("ProtoN payload is too short for its container lengths")
+
+
+def validate(payload, limits=None, dictionary=None):
+    """ Checks that a payload is exactly one well formed ProtoN message within
+    the given limits, without building any of its values. Only opcodes,
+    lengths and back-reference indices are read, and every length is
+    checked against the limits and the bytes left before it is used, so
+    hostile lengths are rejected as soon as they are read. Raises
+    TruncatedPayload, LimitExceeded or ValueError if the message is invalid.
+    The bytes of strings and short floats are not parsed, so decoding a
+    valid message may still fail on malformed UTF-8 or float digits.
+    A compressed message is checked by decompressing and checking the
+    message it holds.
+    @param {bytes} payload - the ProtoN message to check
+    @param {Limits} limits - the limits to enforce, or None for the defaults
+    @param {bytes} dictionary - the preset dictionary of compressed messages
+    """
+    if limits is None:
+        limits = Limits()
+    reader = open_message(BitReader(payload), dictionary, limits.max_size)
+    read = reader.read
+    skip = reader.skip
+    flags = reader.flags
+    varints = flags & FLAG_VARINTS
+    extended = flags & FLAG_EXTENDED_TYPES
+    # Number of keys in the key table, and of filled string table slots
+    keys = 0 if flags & FLAG_KEY_TABLE else None
+    strings = 0 if flags & FLAG_STRING_TABLE else None
+    values = 0
+    # [entries left, entries are pairs, is chunked] of each open container
+    stack = []
+    while True:
+        if stack and stack[-1][1]:
+            if read(3) != TYPE_PAIR:
+                raise ValueError("Expected a pair dtype in object")
+            if keys is not None and read(1):
+                index = read(keys.bit_length())
+                if index >= keys:
+                    raise ValueError("Key back-reference out of range. Got:", index)
+            else:
+                skip_string(reader, limits)
+                if keys is not None:
+                    keys += 1
+        dtype = read(3)
+        values += 1
+        length = 0
+        chunked = False
+        if dtype == TYPE_NULL:
+            pass
+        elif dtype == TYPE_BOOL:
+            skip(1)
+        elif dtype == TYPE_INT:
+            if varints:
+                unpack_varint(reader)
+            else:
+                skip(8 << read(2))
+        elif dtype == TYPE_FLOAT:
+            skip(64 if read(1) else read(3) << 3)
+        elif dtype == TYPE_STRING:
+            if strings is not None and read(1):
+                slot = read(strings.bit_length())
+                if slot >= strings:
+                    raise ValueError("String back-reference out of range. Got:", slot)
+            else:
+                skip_string(reader, limits)
+                if strings is not None and strings < reader.string_table_size:
+                    strings += 1
+        elif dtype == TYPE_LIST or dtype == TYPE_OBJECT:
+            length = unpack_len(reader)
+        elif dtype == TYPE_EXTENSION and extended:
+            ext = read(3)
+            if ext == EXT_PACKED_ARRAY:
+                packed_type = read(3)
+                if packed_type not in packed_sizes:
+                    raise ValueError("Packed element type not recognized. Got:", packed_type)
+                count = unpack_len(reader)
+                values += count
+                reader.align()
+                skip((count * packed_sizes[packed_type]) << 3)
+            elif ext == EXT_CHUNKED_LIST:
+                length = unpack_len(reader)
+                chunked = True
+            else:
+                raise ValueError("Extended type not recognized. Got:", ext)
+        else:
+            raise ValueError("Expected a primitive or container dtype. Got:", dtype)
+        if values > limits.max_elements:
+            raise LimitExceeded("More values than the limit. Got:", values)
+
+        if stack:
+            stack[-1][0] -= 1
+        if length:
+            if len(stack) >= limits.max_depth:
+                raise LimitExceeded("Containers nested deeper than the limit")
+            check_entries(reader, length, values, limits)
+            stack.append([length, dtype == TYPE_OBJECT, chunked])
+            continue
+        # Close every container completed by this value, reading the next
+        # chunk of a chunked list once its last chunk is used up
+        while stack and not stack[-1][0]:
+            if stack[-1][2]:
+                length = unpack_len(reader)
+                if length:
+                    check_entries(reader, length, values, limits)
+                    stack[-1][0] = length
+                    break
+            stack.pop()
+        if not stack:
+            break
+
+    # Only zero padding may follow the message, up to the end of its last byte
+    if read(-reader.pos & 7):
+        raise ValueError("ProtoN message padding is not zero")
+    if reader.pos != reader.end:
+        raise ValueError("ProtoN payload continues after the message. Got bytes:",
+                         (reader.end - reader.pos) >> 3)
+
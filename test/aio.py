@@ -0,0 +1 @@
+../src/python/aio.py
\ No newline at end of file
@@ -0,0 +1 @@
+../src/python/archive.py
\ No newline at end of file
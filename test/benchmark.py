@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+from sys import argv, exit, version
+from os.path import isdir, join
+from os import listdir
+from subprocess import check_output, CalledProcessError, DEVNULL
+from json import load, loads, dumps
+from pickle import HIGHEST_PROTOCOL
+from time import perf_counter
+from math import ceil, exp, log
+import pickle
+import random
+import tracemalloc
+from encoder import *
+from decoder import *
+from test_generator import *
+
+# Seed of the synthetic workloads, so every run measures the same values
+SEED = 0x70726f
+# Each measurement repeats passes over a workload until it has timed at
+# least SAMPLES messages and taken at least MIN_TIME seconds, so the p99 is
+# not simply the slowest message
+SAMPLES = 200
+MIN_TIME = 0.5
+# Least number of passes over a workload, so that every operation is timed
+# at several moments of the run
+PASSES = 5
+# Relative slowdown beyond which --compare reports a regression
+TOLERANCE = 0.1
+# Codecs of this library, whose regressions are reported. The others are
+# references, which only show how fast the machine ran.
+GATED_CODECS = ('proton', 'proton-packed')
+# Sizes of the synthetic workloads
+WIDE_KEYS = 2**10
+DEEP_LEVELS = 2**8
+NUMERIC_LENGTH = 2**11
+LONG_STRINGS = 2**5
+LONG_STRING_LENGTH = 2**14
+
+# Encode and decode functions of each format, on one value
+codecs = {
+    'proton': (encode, decode),
+    'proton-packed': (lambda obj: encode(obj, packed_arrays=True), decode),
+    'json': (lambda obj: dumps(obj, separators=(',',':')).encode('utf-8'), loads),
+    'pickle': (lambda obj: pickle.dumps(obj, HIGHEST_PROTOCOL), pickle.loads),
+}
+
+def usage():
+    """ Bad CLI options passed """
+    print("Usage:", argv[0], "directory [--output file] [--compare file] [--samples n]",
+          "[--min-time seconds] [--workload name] [--codec name] [--tolerance fraction]")
+    exit()
+
+def wide_object():
+    """ One object with many keys of primitive values """
+    values = [rand_null, rand_bool, rand_int, rand_float, rand_string]
+    return {random_string(): choice(values)() for _ in range(WIDE_KEYS)}
+
+def deep_object():
+    """ Objects nested one within another, each with a few primitives """
+    obj = {}
+    for level in range(DEEP_LEVELS):
+        obj = {'level': level, 'name': rand_string(), 'ok': rand_bool(), 'child': obj}
+    return obj
+
+def numeric_arrays():
+    """ Long lists of ints and of floats """
+    return {'ints': [rand_int() for _ in range(NUMERIC_LENGTH)],
+            'floats': [rand_float() for _ in range(NUMERIC_LENGTH)]}
+
+def long_strings():
+    """ A list of long strings """
+    return [random_string(LONG_STRING_LENGTH) for _ in range(LONG_STRINGS)]
+
+def workloads(dir):
+    """ Returns the name and values of every workload, where each value is
+    encoded or decoded as one message """
+    corpus = []
+    for filename in sorted(listdir(dir)):
+        if filename.endswith(".json"):
+            with open(join(dir,filename), 'r') as f:
+                corpus.append(load(f))
+    random.seed(SEED)
+    return [('corpus', corpus), ('wide', [wide_object()]), ('deep', [deep_object()]),
+            ('numeric', [numeric_arrays()]), ('strings', [long_strings()])]
+
+def percentile(timings, fraction):
+    """ Returns the nearest-rank percentile of sorted timings """
+    return timings[max(0, ceil(fraction * len(timings)) - 1)]
+
+def peak_memory(operation, values):
+    """ Returns the peak bytes allocated by a pass over a workload's values,
+    measured after a warm-up pass and apart from the timed passes, as
+    tracing slows them """
+    for value in values:
+        operation(value)
+    tracemalloc.start()
+    for value in values:
+        operation(value)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def time_pass(operation, values, timings):
+    """ Times an operation on each of a workload's values separately """
+    for value in values:
+        start = perf_counter()
+        operation(value)
+        timings.append(perf_counter() - start)
+
+def summarize(timings, passes, size, peak):
+    """ Returns the stats per message of an operation's timings
+    @param {list} timings - seconds taken by each message
+    @param {int} passes - number of passes over the workload's values
+    @param {int} size - total bytes of the workload's encoded messages
+    @param {int} peak - peak bytes allocated by one pass
+    """
+    total = sum(timings)
+    timings = sorted(timings)
+    return {'messages': len(timings),
+            'ops_per_sec': round(len(timings) / total, 3),
+            'mb_per_sec': round(size * passes / total / 1e6, 3),
+            'p50_ms': round(percentile(timings, 0.5) * 1e3, 4),
+            'p99_ms': round(percentile(timings, 0.99) * 1e3, 4),
+            'peak_kb': round(peak / 1024, 1)}
+
+def commit():
+    """ Returns the git commit being benchmarked, or None outside a repo """
+    try:
+        return check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                            stderr=DEVNULL).decode('utf-8').strip()
+    except (CalledProcessError, OSError):
+        return None
+
+def benchmark(dir, samples, min_time, only_workload=None, only_codec=None):
+    """ Runs every workload through every codec, and returns the report. The
+    operations of a workload are timed in turn, one pass each at a time, so
+    a change in the machine's speed affects all of them alike.
+    @param {int} samples - least number of messages each operation times
+    @param {float} min_time - least number of seconds spent on a workload
+    """
+    results = []
+    for workload, values in workloads(dir):
+        if only_workload and workload != only_workload:
+            continue
+        # [result, operation, inputs, timings] of every operation
+        measured = []
+        for codec, (encoder, decoder) in codecs.items():
+            if only_codec and codec != only_codec:
+                continue
+            messages = [encoder(value) for value in values]
+            if [decoder(message) for message in messages] != values:
+                raise ValueError("Round trip changed the values of", workload, codec)
+            size = sum(len(message) for message in messages)
+            for operation, function, inputs in (('encode', encoder, values),
+                                                 ('decode', decoder, messages)):
+                result = {'workload': workload, 'codec': codec, 'operation': operation,
+                          'size': size, 'peak': peak_memory(function, inputs)}
+                measured.append([result, function, inputs, []])
+        passes = 0
+        start = perf_counter()
+        while measured and (passes < PASSES or len(measured[0][3]) < samples
+                            or perf_counter() - start < min_time):
+            for result, function, inputs, timings in measured:
+                time_pass(function, inputs, timings)
+            passes += 1
+        for result, function, inputs, timings in measured:
+            result.update(summarize(timings, passes, result['size'], result.pop('peak')))
+            results.append(result)
+            print_result(result)
+    return {'commit': commit(), 'python': version.split()[0], 'seed': SEED,
+            'results': results}
+
+def print_result(result):
+    """ Prints one result as a line of the table """
+    print("\u001b[1m" + result['workload'] + " " + result['codec'] + " " +
+          result['operation'] + "\u001b[0m",
+          result['ops_per_sec'], "messages/s,", result['mb_per_sec'], "MB/s,",
+          "p50", result['p50_ms'], "ms, p99", result['p99_ms'], "ms,",
+          "peak", result['peak_kb'], "KB,", result['size'], "bytes")
+
+def compare(report, baseline, tolerance):
+    """ Prints the change in throughput of every result also in the
+    baseline, and returns the number of regressions beyond the tolerance.
+    Only the gated codecs can regress. Their change is divided by how much
+    faster or slower the machine ran, taken as the geometric mean change of
+    the other codecs on the same workload and operation, so a busier
+    machine is not a regression. """
+    previous = {(r['workload'], r['codec'], r['operation']): r
+                for r in baseline['results']}
+    changes = []
+    # Log changes of the reference codecs on each workload and operation
+    references = {}
+    for result in report['results']:
+        key = (result['workload'], result['operation'])
+        before = previous.get((result['workload'], result['codec'], result['operation']))
+        if before is None:
+            continue
+        ratio = result['ops_per_sec'] / before['ops_per_sec']
+        changes.append((result, before, ratio))
+        if result['codec'] not in GATED_CODECS:
+            references.setdefault(key, []).append(log(ratio))
+    print("\nCompared to", baseline.get('commit') or "baseline")
+    regressions = 0
+    for result, before, ratio in changes:
+        regressed = improved = False
+        line = ["{:+.1%}".format(ratio - 1), "ops/s"]
+        logs = references.get((result['workload'], result['operation']))
+        if result['codec'] in GATED_CODECS:
+            change = ratio / (exp(sum(logs) / len(logs)) if logs else 1.0) - 1
+            regressed, improved = change < -tolerance, change > tolerance
+            regressions += regressed
+            if logs:
+                line += ["({:+.1%}".format(change), "for machine speed)"]
+        line += [",", "{:+.1%}".format(result['peak_kb'] / max(before['peak_kb'], 0.1) - 1),
+                 "peak memory"]
+        print("\u001b[1m" + result['workload'] + " " + result['codec'] + " " +
+              result['operation'] + "\u001b[0m",
+              "\u001b[31m" if regressed else "\u001b[32m" if improved else "",
+              *line, "\u001b[0m")
+    return regressions
+
+def main():
+    """ Main point of entry for CLI """
+    # Check for correct arguments
+    if len(argv) < 2 or not isdir(argv[1]) or len(argv) % 2:
+        usage()
+    options = dict(zip(argv[2::2], argv[3::2]))
+    if set(options) - {'--output', '--compare', '--samples', '--min-time',
+                       '--workload', '--codec', '--tolerance'}:
+        usage()
+    report = benchmark(argv[1], int(options.get('--samples', SAMPLES)),
+                       float(options.get('--min-time', MIN_TIME)),
+                       options.get('--workload'), options.get('--codec'))
+    if '--output' in options:
+        with open(options['--output'], 'w') as f:
+            f.write(dumps(report, indent=2) + "\n")
+    if '--compare' in options:
+        with open(options['--compare'], 'r') as f:
+            baseline = load(f)
+        if compare(report, baseline, float(options.get('--tolerance', TOLERANCE))):
+            exit(1)
+
+if __name__ == '__main__':
+    main()
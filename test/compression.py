@@ -0,0 +1 @@
+../src/python/compression.py
\ No newline at end of file
@@ -5,6 +5,7 @@ from os import listdir
 from subprocess import check_output
 from json import load, dumps
 from zlib import compress
+from time import perf_counter
 from encoder import *
 from decoder import *
 
@@ -13,6 +14,16 @@ def usage():
     print("Usage:", argv[0], "directory")
     exit()
 
+def timed(function, *args, **kwargs):
+    """ Returns the result of a call along with its duration in seconds """
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    return result, perf_counter() - start
+
+def throughput(size, seconds):
+    """ Formats a byte count processed in `seconds` as MB/s """
+    return str(round(size / seconds / 1e6, 2)) + " MB/s"
+
 def main():
     """ Main point of entry for CLI """
     # Check for correct arguments
@@ -23,6 +34,13 @@ def main():
     proton_sz = 0
     comp_json_sz = 0
     comp_proton_sz = 0
+    keys_proton_sz = 0
+    varints_proton_sz = 0
+    strings_proton_sz = 0
+    # Encode and decode times of plain, key table, varint and string table messages
+    enc_time = dec_time = keys_enc_time = keys_dec_time = 0
+    varints_enc_time = varints_dec_time = 0
+    strings_enc_time = strings_dec_time = 0
     for filename in listdir(dir):
         if filename.endswith(".json"):
             with open(join(dir,filename), 'r') as f:
@@ -31,11 +49,38 @@ def main():
             this_json = len(dumps(obj, separators=(',',':')).encode('utf-8'))
             json_sz += this_json
             # Add size of ProtoN
-            this_proton = len(encode(obj))
+            enc, seconds = timed(encode, obj)
+            enc_time += seconds
+            dec_time += timed(decode, enc)[1]
+            this_proton = len(enc)
             proton_sz += this_proton
+            # Add size of ProtoN with the key table extension
+            keys_enc, seconds = timed(encode, obj, key_table=True)
+            keys_enc_time += seconds
+            keys_dec_time += timed(decode, keys_enc)[1]
+            this_keys_proton = len(keys_enc)
+            keys_proton_sz += this_keys_proton
+            # Add size of ProtoN with the varints extension
+            varints_enc, seconds = timed(encode, obj, varints=True)
+            varints_enc_time += seconds
+            varints_dec_time += timed(decode, varints_enc)[1]
+            this_varints_proton = len(varints_enc)
+            varints_proton_sz += this_varints_proton
+            # Add size of ProtoN with the string table extension
+            strings_enc, seconds = timed(encode, obj, string_table=True)
+            strings_enc_time += seconds
+            strings_dec_time += timed(decode, strings_enc)[1]
+            this_strings_proton = len(strings_enc)
+            strings_proton_sz += this_strings_proton
             print("Testing \u001b[1m" + filename +
                     "\u001b[0m JSON:", this_json, "ProtoN:", this_proton,
-                    "   \u001b[33m" + str(this_proton/this_json) + "\u001b[0m")
+                    "   \u001b[33m" + str(this_proton/this_json) + "\u001b[0m",
+                    "ProtoN+Keys:", this_keys_proton,
+                    "   \u001b[33m" + str(this_keys_proton/this_json) + "\u001b[0m",
+                    "ProtoN+Varints:", this_varints_proton,
+                    "   \u001b[33m" + str(this_varints_proton/this_json) + "\u001b[0m",
+                    "ProtoN+Strings:", this_strings_proton,
+                    "   \u001b[33m" + str(this_strings_proton/this_json) + "\u001b[0m")
             # Repeat the test with GZip-ed results
             this_comp_json = len(compress(dumps(obj, separators=(',',':')).encode('utf-8'), level=9))
             comp_json_sz += this_comp_json
@@ -51,6 +96,18 @@ def main():
     print("\n\u001b[33mProtoN/JSON Size:", proton_sz/json_sz, "\u001b[0m")
     print("\n\u001b[33mGZip ProtoN/GZip JSON Size:", comp_proton_sz/comp_json_sz, "\u001b[0m")
     print("\n\u001b[33mProtoN/GZip JSON Size:", proton_sz/comp_json_sz, "\u001b[0m")
+    print("\n\u001b[33mProtoN+Keys/JSON Size:", keys_proton_sz/json_sz, "\u001b[0m")
+    print("\n\u001b[33mProtoN+Keys/GZip JSON Size:", keys_proton_sz/comp_json_sz, "\u001b[0m")
+    print("\n\u001b[33mProtoN+Varints/JSON Size:", varints_proton_sz/json_sz, "\u001b[0m")
+    print("\n\u001b[33mProtoN+Strings/JSON Size:", strings_proton_sz/json_sz, "\u001b[0m")
+    print("\n\u001b[33mProtoN Encode (of JSON size):", throughput(json_sz, enc_time),
+            " Decode:", throughput(json_sz, dec_time), "\u001b[0m")
+    print("\n\u001b[33mProtoN+Keys Encode (of JSON size):", throughput(json_sz, keys_enc_time),
+            " Decode:", throughput(json_sz, keys_dec_time), "\u001b[0m")
+    print("\n\u001b[33mProtoN+Varints Encode (of JSON size):", throughput(json_sz, varints_enc_time),
+            " Decode:", throughput(json_sz, varints_dec_time), "\u001b[0m")
+    print("\n\u001b[33mProtoN+Strings Encode (of JSON size):", throughput(json_sz, strings_enc_time),
+            " Decode:", throughput(json_sz, strings_dec_time), "\u001b[0m")
     print("\n" + ('-'*30))
 
 if __name__ == '__main__':
@@ -0,0 +1 @@
+../src/python/lazy.py
\ No newline at end of file
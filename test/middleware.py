@@ -0,0 +1 @@
+../src/python/middleware.py
\ No newline at end of file
@@ -0,0 +1 @@
+../src/python/schema.py
\ No newline at end of file
@@ -1,18 +1,349 @@
 #!/usr/bin/env python3
 from sys import argv, exit
 from os.path import isdir, join
-from os import listdir
+from os import listdir, stat, utime
 from subprocess import check_output
-from json import load
+from json import load, dumps
+from io import BytesIO
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import TemporaryDirectory, TemporaryFile
+from mmap import mmap, ACCESS_READ
 from encoder import *
 from decoder import *
+from lazy import decode_lazy
+from validator import validate, Limits
+from compression import Compression, train_dictionary, zstandard
+from archive import decode_file
+from schema import Schema
+from aio import serve, connect, MessageStream
+from middleware import ProtoNMiddleware, ProtoNASGIMiddleware, ResponseCache
+import asyncio
 from pprint import pprint
+from dataclasses import dataclass
+from enum import IntEnum
 
 def usage():
     """ Bad CLI options passed """
     print("Usage:", argv[0], "directory")
     exit()
 
+async def echo(objs):
+    """ Sends every object through an asyncio echo server and returns the
+    replies, offloading the larger messages and compressing those above the
+    threshold with a preset dictionary """
+    dictionary = train_dictionary([encode(obj) for obj in objs[::2]])
+    options = {'compression': Compression(dictionary=dictionary), 'dictionary': dictionary}
+    done = asyncio.Event()
+    async def handler(stream):
+        async for obj in stream:
+            await stream.write(obj)
+        done.set()
+    server = await serve(handler, '127.0.0.1', 0, offload_size=256, offload_length=16,
+                         **options)
+    port = server.sockets[0].getsockname()[1]
+    stream = await connect('127.0.0.1', port, offload_size=256, offload_length=16, **options)
+    replies = []
+    for obj in objs:
+        await stream.write(obj)
+        replies.append(await stream.read())
+    await stream.close()
+    await done.wait()
+    server.close()
+    await server.wait_closed()
+    return replies
+
+async def oversized():
+    """ Returns whether a frame announcing more than max_size bytes is
+    rejected before it is read """
+    reader = asyncio.StreamReader()
+    reader.feed_data((2**31).to_bytes(FRAME_LENGTH_BYTES, 'big'))
+    try:
+        await MessageStream(reader, None, max_size=2**10).read()
+    except LimitExceeded:
+        return True
+    return False
+
+# Limit on the messages a compression bomb expands past
+BOMB_LIMIT = 2**16
+
+def bombs():
+    """ Returns a small compressed message of each codec which holds a
+    message of far more than BOMB_LIMIT bytes """
+    codecs = ('zlib', 'lzma', 'zstd') if zstandard else ('zlib', 'lzma')
+    return [encode('a' * 2**22, compression=Compression(codec)) for codec in codecs]
+
+# Message for the selection tests, whose keys and strings repeat so that the
+# key and string tables send back-references to values which are skipped
+SELECTABLE = {'user': {'name': 'ann', 'age': 30, 'tags': ['a', 'b', 'c']},
+              'items': [{'id': 1, 'v': 'x'}, {'id': 2, 'v': 'y'}, {'id': 3, 'v': 'x'}],
+              'n': 5}
+# Each selection of SELECTABLE and the value it decodes to
+SELECTIONS = [
+    (['n'], {'n': 5}),
+    (['user.name'], {'user': {'name': 'ann'}}),
+    (['user.tags[1]'], {'user': {'tags': ['b']}}),
+    (['items[-1]'], {'items': [{'id': 3, 'v': 'x'}]}),
+    (['items[-1].v'], {'items': [{'v': 'x'}]}),
+    (['items[*].id'], {'items': [{'id': 1}, {'id': 2}, {'id': 3}]}),
+    # Overlapping paths select their union, whichever comes first
+    (['user', 'user.name'], {'user': SELECTABLE['user']}),
+    (['user.name', 'user'], {'user': SELECTABLE['user']}),
+    (['items[*].id', 'items[0]', 'items[2].v'],
+     {'items': [{'id': 1, 'v': 'x'}, {'id': 2}, {'id': 3, 'v': 'x'}]}),
+    (['missing', 'items[9]'], {'items': []}),
+    (['n.missing'], {}),
+]
+
+def selects(payload):
+    """ Returns whether every selection of SELECTABLE decodes as expected,
+    also through a Decoder and through decode_selected directly """
+    reused = Decoder()
+    for paths, expected in SELECTIONS:
+        direct = decode_selected(open_message(BitReader(payload)), compile_selection(paths))
+        if (decode(payload, select=paths) != expected or reused.decode(payload, paths) != expected
+                or direct != expected):
+            return False
+    return True
+
+def rejects_path(path):
+    """ Returns whether a selector path is rejected as malformed """
+    try:
+        compile_selection([path])
+    except ValueError:
+        return True
+    return False
+
+def decodes_buffers(obj, payload):
+    """ Returns whether a payload decodes to obj when read from a bytearray,
+    a memoryview and a memory map instead of bytes """
+    with TemporaryFile() as f:
+        f.write(payload)
+        f.flush()
+        with mmap(f.fileno(), 0, access=ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                return all(decode(buffer) == obj for buffer in
+                           (bytearray(payload), memoryview(payload), mapped, view))
+            finally:
+                view.release()
+
+def rejects_bomb(read, bomb):
+    """ Returns whether reading a compression bomb fails on the size limit """
+    try:
+        read(bomb)
+    except LimitExceeded:
+        return True
+    return False
+
+async def stream_bomb(bomb):
+    """ Returns whether a MessageStream rejects a compression bomb """
+    reader = asyncio.StreamReader()
+    reader.feed_data(len(bomb).to_bytes(FRAME_LENGTH_BYTES, 'big') + bomb)
+    try:
+        await MessageStream(reader, None, max_size=BOMB_LIMIT).read()
+    except LimitExceeded:
+        return True
+    return False
+
+def wsgi_bomb(bomb):
+    """ Returns the status with which the WSGI middleware answers a
+    compression bomb """
+    environ = {'CONTENT_TYPE': 'proton', 'CONTENT_LENGTH': str(len(bomb)),
+               'wsgi.input': BytesIO(bomb)}
+    status = []
+    ProtoNMiddleware(json_echo, max_size=BOMB_LIMIT)(
+        environ, lambda *response: status.append(response[0]))
+    return status[0]
+
+async def asgi_bomb(bomb):
+    """ Returns the status with which the ASGI middleware answers a
+    compression bomb """
+    async def receive():
+        return {'type': 'http.request', 'body': bomb}
+    sent = []
+    async def send(message):
+        sent.append(message)
+    scope = {'type': 'http', 'headers': [(b'content-type', b'proton')]}
+    await ProtoNASGIMiddleware(asgi_json_echo, max_size=BOMB_LIMIT)(scope, receive, send)
+    return sent[0]['status']
+
+@dataclass
+class Point:
+    x: int
+    y: float
+    label: str = None
+
+class SlottedPoint(object):
+    __slots__ = ('x', 'y', 'label')
+    def __init__(self, x, y, label=None):
+        self.x, self.y, self.label = x, y, label
+
+class Level(IntEnum):
+    LOW = -3
+    HIGH = 300
+
+class Ratio(float):
+    def __repr__(self):
+        return 'Ratio(' + float.__repr__(self) + ')'
+
+class Rows(object):
+    """ Iterable which is neither a sequence nor an iterator, with fields of
+    its own which must not be sent """
+    def __init__(self, rows):
+        self.conn = 'db'
+        self.rows = rows
+    def __iter__(self):
+        return iter(self.rows)
+
+class Node(object):
+    """ Plain class without a plan, encoded through vars() """
+
+def rejects_cycle(obj):
+    """ Returns whether encoding obj fails on a circular reference """
+    try:
+        encode(obj)
+    except ValueError:
+        return True
+    return False
+
+def json_echo(environ, start_response):
+    """ WSGI app which responds with its JSON request body """
+    body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [body]
+
+async def asgi_json_echo(scope, receive, send):
+    """ ASGI app which responds with its JSON request body """
+    body = (await receive())['body']
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+def wsgi_echo(objs):
+    """ Posts every object twice through the WSGI middleware, the second time
+    from its cache, and returns the decoded replies """
+    app = ProtoNMiddleware(json_echo)
+    replies = []
+    for obj in objs * 2:
+        body = encode(obj)
+        environ = {'CONTENT_TYPE': 'proton', 'CONTENT_LENGTH': str(len(body)),
+                   'HTTP_ACCEPT': 'proton', 'wsgi.input': BytesIO(body)}
+        replies.append(decode(b''.join(app(environ, lambda status, headers: None))))
+    return replies
+
+def path_echo(environ, start_response):
+    """ WSGI app which responds with its path, under the same weak ETag for
+    every path """
+    body = dumps({'path': environ['PATH_INFO']}).encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'application/json'), ('ETag', 'W/"1"')])
+    return [body]
+
+def wsgi_cache_keys():
+    """ Returns whether a shared response cache keeps apart responses with
+    the same ETag for different paths or encode() options """
+    cache = ResponseCache()
+    apps = [ProtoNMiddleware(path_echo, cache), ProtoNMiddleware(path_echo, cache, varints=True)]
+    for app, varints in zip(apps, (False, True)):
+        for path in ('/users', '/orders', '/users'):
+            environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'HTTP_ACCEPT': 'proton'}
+            body = b''.join(app(environ, lambda status, headers: None))
+            if body != encode({'path': path}, varints=varints):
+                return False
+    return True
+
+def wsgi_passthrough():
+    """ Returns whether the WSGI middleware passes on responses which are not
+    translated as they are, without buffering them, and translates a JSON
+    response started only once the app's result is iterated """
+    chunks = iter([b'plain', b'text'])
+    def plain(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return chunks
+    def lazy(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        yield b'{"a":'
+        yield b'1}'
+    statuses = []
+    def start_response(status, headers):
+        statuses.append(status)
+    environ = {'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT': 'proton'}
+    if (ProtoNMiddleware(plain)(environ, start_response) is not chunks
+            or decode(b''.join(ProtoNMiddleware(lazy)(environ, start_response))) != {'a': 1}):
+        return False
+    # Responses without a body
+    for method, status in (('HEAD', '200 OK'), ('GET', '204 No Content'),
+                           ('GET', '304 Not Modified'), ('GET', '200 OK')):
+        def empty(environ, start_response):
+            start_response(status, [('Content-Type', 'application/json')])
+            return []
+        body = b''.join(ProtoNMiddleware(empty)(dict(environ, REQUEST_METHOD=method),
+                                                start_response))
+        if body or statuses[-1] != status:
+            return False
+    return True
+
+async def asgi_passthrough():
+    """ Returns whether the ASGI middleware passes on each message of a
+    response which is not translated as soon as the app sends it """
+    sent = []
+    async def send(message):
+        sent.append(message)
+    # Number of messages sent on as the app sends each of its own
+    streamed = []
+    async def plain(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/plain')]})
+        streamed.append(len(sent))
+        await send({'type': 'http.response.body', 'body': b'plain', 'more_body': True})
+        streamed.append(len(sent))
+        await send({'type': 'http.response.body', 'body': b'text'})
+    scope = {'type': 'http', 'method': 'GET', 'headers': [(b'accept', b'proton')]}
+    await ProtoNASGIMiddleware(plain)(scope, None, send)
+    if streamed != [1, 2]:
+        return False
+    # Responses without a body
+    for method, status in (('HEAD', 200), ('GET', 204), ('GET', 304), ('GET', 200)):
+        async def empty(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(b'content-type', b'application/json')]})
+            await send({'type': 'http.response.body', 'body': b''})
+        sent.clear()
+        await ProtoNASGIMiddleware(empty)(dict(scope, method=method), None, send)
+        if sent[0]['status'] != status or sent[-1]['body']:
+            return False
+    return True
+
+async def asgi_disconnect():
+    """ Returns whether an app reading past a translated request body
+    receives the server's http.disconnect """
+    messages = [{'type': 'http.request', 'body': encode({'a': 1})},
+                {'type': 'http.disconnect'}]
+    received = []
+    async def app(scope, receive, send):
+        received.extend([await receive(), await receive()])
+    async def receive():
+        return messages.pop(0)
+    scope = {'type': 'http', 'headers': [(b'content-type', b'proton')]}
+    await ProtoNASGIMiddleware(app)(scope, receive, None)
+    return [message['type'] for message in received] == ['http.request', 'http.disconnect']
+
+async def asgi_echo(objs):
+    """ Posts every object through the ASGI middleware and returns the
+    decoded replies """
+    app = ProtoNASGIMiddleware(asgi_json_echo)
+    replies = []
+    for obj in objs:
+        async def receive():
+            return {'type': 'http.request', 'body': encode(obj)}
+        sent = []
+        async def send(message):
+            sent.append(message)
+        scope = {'type': 'http', 'headers': [(b'content-type', b'proton'), (b'accept', b'proton')]}
+        await app(scope, receive, send)
+        replies.append(decode(sent[-1]['body']))
+    return replies
+
 def main():
     """ Main point of entry for CLI """
     # Check for correct arguments
@@ -21,10 +352,18 @@ def main():
     dir = argv[1]
     succ = 0
     fail = 0
+    objs = []
+    pool = ProcessPoolExecutor(2)
+    # Compresses nearly every message, so the compressed path is tested
+    compression = Compression(threshold=16)
+    # Reused across every file, as a server would
+    encoder = Encoder()
+    decoder = Decoder()
     for filename in listdir(dir):
         if filename.endswith(".json"):
             with open(join(dir,filename), 'r') as f:
                 obj = load(f)
+            objs.append(obj)
             # Do the PY testing
             print("Testing \u001b[1m" + filename + "\u001b[0m PY...", end="")
             enc = encode(obj)
@@ -34,6 +373,133 @@ def main():
             else:
                 print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
                 fail += 1
+            # Do the PY streaming testing, feeding one byte at a time
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-STREAM...", end="")
+            stream = StreamDecoder(values=True)
+            values = []
+            for i in range(len(enc)):
+                values += stream.feed(enc[i:i+1])
+            if values == [obj]:
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY streaming encoder testing with a small output buffer
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-ENCODE-TO...", end="")
+            out = BytesIO()
+            encode_to(obj, out, buffer_size=16)
+            if out.getvalue() == enc:
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY testing with every version 2 extension enabled
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-EXTENSIONS...", end="")
+            if obj == decode(encode(obj, key_table=True, packed_arrays=True)):
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY testing with varint ints and lengths, also skipping
+            # over every value lazily
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-VARINTS...", end="")
+            varint_enc = encode(obj, varints=True)
+            if obj == decode(varint_enc) and decode_lazy(varint_enc) == obj:
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY testing with the string table, small enough that
+            # strings are evicted, also decoding while streamed
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-STRINGS...", end="")
+            strings_enc = encode(obj, string_table=True, string_table_size=4)
+            stream = StreamDecoder(values=True)
+            if obj == decode(strings_enc) and stream.feed(strings_enc) == [obj]:
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY compression testing, also streamed in small pieces
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-COMPRESSED...", end="")
+            compressed_enc = encode(obj, compression=compression)
+            stream = StreamDecoder(values=True)
+            streamed = []
+            for i in range(0, len(compressed_enc), 7):
+                streamed += stream.feed(compressed_enc[i:i + 7])
+            written = BytesIO()
+            encode_to(obj, written, buffer_size=64, compression=compression)
+            if (obj == decode(compressed_enc) and streamed == [obj]
+                    and validate(compressed_enc) is None
+                    and decode(written.getvalue()) == obj):
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY testing from buffers other than bytes
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-BUFFERS...", end="")
+            if decodes_buffers(obj, enc) and decodes_buffers(obj, compressed_enc):
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY testing with a reused Encoder and Decoder
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-REUSE...", end="")
+            buffer = bytearray()
+            nbits = encoder.encode_into(obj, buffer)
+            if (encoder.encode(obj) == enc and bytes(buffer) == enc
+                    and (nbits + 7) >> 3 == len(enc) and decoder.decode(enc) == obj):
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY parallel encoding testing, which must match a serial encode
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-PARALLEL...", end="")
+            if encode(obj, workers=pool) == enc:
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY schema testing, with a schema compiled from the file itself
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-SCHEMA...", end="")
+            schema = Schema.from_sample(obj)
+            if schema.encode(obj) == enc and schema.decode(enc) == obj and not schema.fallbacks:
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY validation testing, which must pass the message and
+            # reject it cut short or followed by another byte
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-VALIDATE...", end="")
+            rejected = 0
+            for payload in (enc[:-1], enc + bytes(1)):
+                try:
+                    validate(payload)
+                except ValueError:
+                    rejected += 1
+            if validate(enc) is None and rejected == 2:
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
+            # Do the PY lazy decoding testing, which compares entry by entry
+            print("Testing \u001b[1m" + filename + "\u001b[0m PY-LAZY...", end="")
+            if decode_lazy(enc) == obj:
+                print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+                succ += 1
+            else:
+                print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+                fail += 1
             # Get JS encoded bytes
             js = check_output(['./proton_test.js', join(dir,filename)]).decode('utf-8').rstrip()
 
@@ -65,6 +531,182 @@ def main():
                     return
                     fail += 1
 
+    # Do the PY batch testing, with every file as one message of a batch
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-MANY...", end="")
+    if objs == decode_many(encode_many(objs)):
+        print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+        succ += 1
+    else:
+        print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+        fail += 1
+    # Do the PY chunked list testing, with every file as an element of a
+    # generator, also decoding while streamed in small pieces
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-CHUNKED...", end="")
+    chunked_enc = encode((obj for obj in objs), chunked_lists=True)
+    stream = StreamDecoder(values=True)
+    values = []
+    for i in range(0, len(chunked_enc), 7):
+        values += stream.feed(chunked_enc[i:i+7])
+    # Iterators among the children of a parallel encode are collected
+    parallel_enc = encode({'objs': (obj for obj in objs)}, workers=pool)
+    # Other iterables are lists, chunked or not
+    indexed = dict(enumerate(objs))
+    iterables = [{'objs': indexed.values()}, {'objs': Rows(objs)}]
+    if (objs == decode(chunked_enc) and values == [objs]
+            and decode(parallel_enc) == {'objs': objs}
+            and all(decode(encode(iterable, chunked_lists=chunked)) == {'objs': objs}
+                    for iterable in iterables for chunked in (False, True))):
+        print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+        succ += 1
+    else:
+        print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+        fail += 1
+    # Do the PY packed array testing, with lists and array.array values long
+    # enough to be packed, through every way of reading a message
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-PACKED...", end="")
+    arrays = {'ints': list(range(-4, 8)), 'floats': [i / 4 for i in range(10)],
+              'bytes': array('B', range(12)), 'singles': array('f', [i - 3.5 for i in range(8)]),
+              'shorts': array('h', range(-300, 300, 60))}
+    packed = dict(arrays, name='packed')
+    plain = dict(((key, list(value)) for key, value in arrays.items()), name='packed')
+    packed_enc = encode(packed, packed_arrays=True)
+    as_arrays = decode(packed_enc, arrays='array')
+    typecodes = {'ints': 'b', 'floats': 'd', 'bytes': 'B', 'singles': 'f', 'shorts': 'h'}
+    stream = StreamDecoder(values=True)
+    streamed = []
+    for i in range(0, len(packed_enc), 5):
+        streamed += stream.feed(packed_enc[i:i + 5])
+    if (decode(packed_enc) == plain and streamed == [plain] and decode_lazy(packed_enc) == plain
+            and all(isinstance(as_arrays[key], array) and as_arrays[key].typecode == typecode
+                    and list(as_arrays[key]) == plain[key]
+                    for key, typecode in typecodes.items())
+            and decode(packed_enc, select=['ints[-1]', 'singles[*]', 'bytes[2]', 'name'])
+            == {'ints': [7], 'singles': plain['singles'], 'bytes': [2], 'name': 'packed'}
+            and validate(packed_enc) is None):
+        print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+        succ += 1
+    else:
+        print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+        fail += 1
+    # Do the PY selection testing, with each table and varints, which change
+    # how skipped values are read
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-SELECT...", end="")
+    options = [{}, {'key_table': True}, {'varints': True},
+               {'string_table': True, 'string_table_size': 2}, {'packed_arrays': True}]
+    if (all(selects(encode(SELECTABLE, **option)) for option in options)
+            and compile_selection(['items[*].id', 'items[*]', 'a.b[-1]'])
+            == {b'items': {WILDCARD: None}, b'a': {b'b': {-1: None}}}
+            and all(rejects_path(path) for path in ('', 'a..b', 'a[', 'a[x]', 'a[1]]'))):
+        print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+        succ += 1
+    else:
+        print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+        fail += 1
+    # Do the PY batch file testing, decoding small ranges across the pool
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-FILE...", end="")
+    with TemporaryDirectory() as tmp:
+        path = join(tmp, "batch.ptn")
+        with open(path, 'wb') as f:
+            f.write(encode_many(objs))
+        # The same records compressed with a preset dictionary
+        compressed_path = join(tmp, "compressed.ptn")
+        dictionary = train_dictionary([encode(obj) for obj in objs[::2]])
+        with open(compressed_path, 'wb') as f:
+            f.write(encode_many(objs, compression=Compression(dictionary=dictionary)))
+        decoded = list(decode_file(path, workers=pool, records_per_task=8))
+        # The batch rewritten as one record of the same size, which must not
+        # be read through the index of the old records
+        size = stat(path).st_size
+        rewritten = 'x' * (2 * size - len(encode_many(['x' * size])))
+        modified = stat(path).st_mtime_ns
+        with open(path, 'wb') as f:
+            f.write(encode_many([rewritten]))
+        utime(path, ns=(modified, modified + 10**9))
+        if (objs == decoded and stat(path).st_size == size
+                and [rewritten] == list(decode_file(path, workers=pool))
+                and objs == list(decode_file(compressed_path, workers=pool, records_per_task=8,
+                                             dictionary=dictionary))):
+            print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+            succ += 1
+        else:
+            print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+            fail += 1
+    pool.shutdown()
+
+    # Do the PY asyncio testing, echoing every file over a local socket
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-ASYNC...", end="")
+    if objs == asyncio.run(echo(objs)) and asyncio.run(oversized()):
+        print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+        succ += 1
+    else:
+        print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+        fail += 1
+
+    # Do the PY class testing, which must match encoding each object's fields
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-CLASSES...", end="")
+    fields = [{'x': i, 'y': i / 2, 'label': str(i)} for i in range(300)]
+    cyclic = Node()
+    cyclic.self = cyclic
+    if (encode([Point(**f) for f in fields]) == encode(fields)
+            and encode([SlottedPoint(**f) for f in fields]) == encode(fields)
+            and rejects_cycle(cyclic) and rejects_cycle(Point(0, 0.0, cyclic))):
+        print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+        succ += 1
+    else:
+        print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+        fail += 1
+
+    # Do the PY subclass testing, whose values must be sent by each codec
+    # as values of their base type
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-SUBCLASSES...", end="")
+    values = [Level.HIGH, 5, Level.LOW, Ratio(0.25), Ratio(1 / 3)]
+    plain = [300, 5, -3, 0.25, 1 / 3]
+    if all(encode(values, varints=varints, floats=floats)
+           == encode(plain, varints=varints, floats=floats)
+           and decode(encode(values, varints=varints, floats=floats)) == plain
+           for varints in (False, True) for floats in (FLOATS_SHORTEST, FLOATS_FLOAT64)):
+        print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+        succ += 1
+    else:
+        print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+        fail += 1
+
+    # Do the PY web middleware testing, with ProtoN requests and responses
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-WSGI...", end="")
+    if objs * 2 == wsgi_echo(objs) and wsgi_cache_keys() and wsgi_passthrough():
+        print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+        succ += 1
+    else:
+        print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+        fail += 1
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-ASGI...", end="")
+    if (objs == asyncio.run(asgi_echo(objs)) and asyncio.run(asgi_disconnect())
+            and asyncio.run(asgi_passthrough())):
+        print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+        succ += 1
+    else:
+        print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+        fail += 1
+
+    # Do the PY compression bomb testing, through every path which
+    # decompresses a message
+    print("Testing \u001b[1m" + dir + "\u001b[0m PY-BOMB...", end="")
+    readers = [lambda bomb: decode(bomb, max_size=BOMB_LIMIT),
+               lambda bomb: decode_many(len(bomb).to_bytes(FRAME_LENGTH_BYTES, 'big') + bomb,
+                                        max_size=BOMB_LIMIT),
+               Decoder(max_size=BOMB_LIMIT).decode,
+               lambda bomb: decode_lazy(bomb, max_size=BOMB_LIMIT),
+               lambda bomb: validate(bomb, Limits(max_size=BOMB_LIMIT)),
+               lambda bomb: StreamDecoder(max_size=BOMB_LIMIT).feed(bomb)]
+    if all(all(rejects_bomb(read, bomb) for read in readers) and asyncio.run(stream_bomb(bomb))
+           and wsgi_bomb(bomb) == '413 Payload Too Large' and asyncio.run(asgi_bomb(bomb)) == 413
+           for bomb in bombs()):
+        print("\u001b[1m\u001b[32mPASS\u001b[0m\u001b[0m");
+        succ += 1
+    else:
+        print("\u001b[0m\u001b[1mFAIL\u001b[0m\u001b[0m")
+        fail += 1
+
     print("\n" + ('-'*30))
     print("\n\u001b[33mPass:", succ, "\nFail:", fail, "\u001b[0m")
     print("\n" + ('-'*30))
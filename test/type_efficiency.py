@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 from sys import argv, exit
 from json import load, dumps
-from random import random, randint
+from random import random, randint, choice
 from zlib import compress
 from encoder import *
 from decoder import *
@@ -9,10 +9,12 @@ from test_generator import *
 
 # The number of items in the constructed object to test
 TEST_SIZE = 1000
+# The strings --enum values are drawn from, as in a status field
+ENUM_VALUES = ['active', 'pending', 'suspended', 'closed', 'deleted']
 
 def usage():
     """ Bad CLI options passed """
-    print("Usage:", argv[0], "[--list, --object] [--null, --string, --int, --float, --bool, --list, --object, '--smallFloat']")
+    print("Usage:", argv[0], "[--list, --object] [--null, --string, --int, --float, --bool, --list, --object, '--smallFloat', --enum]")
     exit()
 
 def main():
@@ -24,7 +26,7 @@ def main():
     elif len(argv) == 1:
         # If container and value types weren't specified, process all combinations
         containers = ['--list', '--object']
-        values = ['--null', '--string', '--int', '--float', '--bool', '--list', '--object', '--smallFloat']
+        values = ['--null', '--string', '--int', '--float', '--bool', '--list', '--object', '--smallFloat', '--enum']
     else:
         usage()
     # Loop through all specified combinations
@@ -54,6 +56,8 @@ def main():
                 rand = lambda: {}
             elif value == '--smallFloat':
                 rand = lambda: round(random(),randint(1,7))
+            elif value == '--enum':
+                rand = lambda: choice(ENUM_VALUES)
             else:
                 usage()
             # Generate the test object
@@ -70,6 +74,20 @@ def main():
                     "\u001b[0m \u001b[33mProtoN/JSON Size:\u001b[0m",
                     "\u001b[31m" if ratio > 1 else "\u001b[32m",
                     ratio, "\u001b[0m")
+            # ProtoN size with ints and lengths sent as varints
+            varints_ratio = len(encode(obj, varints=True))/json_sz
+            print("\u001b[1m" + container.replace('-','').title() +
+                    "(" + value.replace('-','').title() + ") Varints" +
+                    "\u001b[0m \u001b[33mProtoN/JSON Size:\u001b[0m",
+                    "\u001b[31m" if varints_ratio > 1 else "\u001b[32m",
+                    varints_ratio, "\u001b[0m")
+            # ProtoN size with repeated strings sent as back-references
+            strings_ratio = len(encode(obj, string_table=True))/json_sz
+            print("\u001b[1m" + container.replace('-','').title() +
+                    "(" + value.replace('-','').title() + ") Strings" +
+                    "\u001b[0m \u001b[33mProtoN/JSON Size:\u001b[0m",
+                    "\u001b[31m" if strings_ratio > 1 else "\u001b[32m",
+                    strings_ratio, "\u001b[0m")
             # Add compressed results
             comp_json_sz = len(compress(dumps(obj, separators=(',',':')).encode('utf-8'), level=9))
             comp_proton_sz =len(compress(encode(obj), level=9))
@@ -0,0 +1 @@
+../src/python/validator.py
\ No newline at end of file